@@ -7,14 +7,12 @@ from sqlalchemy import pool
 from alembic import context
 
 from src.models import Base
-from src.database import config
+from src.database import direct_url
 
 from alembic.config import Config
 
-cfg = config()
-url = (
-    f"postgresql://{cfg['user']}:{cfg['password']}@{cfg['host']}:5432/{cfg['database']}"
-)
+# Migrations bypass pgbouncer, if any
+url = direct_url
 
 
 # this is the Alembic Config object, which provides
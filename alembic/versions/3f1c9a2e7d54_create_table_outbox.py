@@ -0,0 +1,49 @@
+"""create-table-outbox
+
+Revision ID: 3f1c9a2e7d54
+Revises: c14c4b6f36b3
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3f1c9a2e7d54"
+down_revision: Union[str, None] = "c14c4b6f36b3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "outbox",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("sender", sa.String(), nullable=False),
+        sa.Column("relayer", sa.String(), nullable=False),
+        sa.Column("branch", sa.String(), nullable=True),
+        sa.Column("contents", sa.JSON(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum(
+                "PENDING",
+                "INJECTED",
+                "FAILED",
+                "CANCELLED",
+                name="outboxstatus",
+            ),
+            nullable=False,
+        ),
+        sa.Column("hash", sa.String(), nullable=True),
+        sa.Column("batch_index", sa.Integer(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("outbox")
+    op.execute("DROP type outboxstatus")
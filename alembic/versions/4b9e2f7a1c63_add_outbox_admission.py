@@ -0,0 +1,36 @@
+"""add-outbox-admission
+
+Revision ID: 4b9e2f7a1c63
+Revises: e1f4b8c2d905
+Create Date: 2026-10-20 09:42:17.318604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4b9e2f7a1c63"
+down_revision: Union[str, None] = "e1f4b8c2d905"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("outbox", sa.Column("vault_id", sa.UUID(), nullable=True))
+    op.create_index("ix_outbox_vault_id_status", "outbox", ["vault_id", "status"])
+    op.create_table(
+        "relayer_batches",
+        sa.Column("relayer", sa.String(), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("relayer"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("relayer_batches")
+    op.drop_index("ix_outbox_vault_id_status", table_name="outbox")
+    op.drop_column("outbox", "vault_id")
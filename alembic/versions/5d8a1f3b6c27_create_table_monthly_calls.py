@@ -0,0 +1,46 @@
+"""create-table-monthly-calls
+
+Revision ID: 5d8a1f3b6c27
+Revises: 7b2e4d91c0a6
+Create Date: 2026-10-18 16:03:52.472119
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5d8a1f3b6c27"
+down_revision: Union[str, None] = "7b2e4d91c0a6"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "monthly_calls",
+        sa.Column("contract_id", sa.UUID(), nullable=False),
+        sa.Column("month", sa.Date(), nullable=False),
+        sa.Column("calls", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["contract_id"],
+            ["contracts.id"],
+        ),
+        sa.PrimaryKeyConstraint("contract_id", "month"),
+    )
+    # Count the operations already recorded
+    op.execute(
+        """
+        INSERT INTO monthly_calls (contract_id, month, calls)
+        SELECT contract_id, date_trunc('month', created_at)::date, count(*)
+        FROM operations
+        WHERE contract_id IS NOT NULL AND created_at IS NOT NULL
+        GROUP BY 1, 2
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("monthly_calls")
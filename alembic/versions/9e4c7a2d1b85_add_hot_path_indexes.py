@@ -0,0 +1,70 @@
+"""add-hot-path-indexes
+
+Revision ID: 9e4c7a2d1b85
+Revises: 5d8a1f3b6c27
+Create Date: 2026-10-18 17:21:14.630957
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9e4c7a2d1b85"
+down_revision: Union[str, None] = "5d8a1f3b6c27"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# name -> (table, columns)
+INDEXES = {
+    "ix_operations_hash": ("operations", ["hash"]),
+    "ix_conditions_sponsee": ("conditions", ["type", "sponsee_address", "vault_id"]),
+    "ix_conditions_entrypoint": (
+        "conditions",
+        ["contract_id", "entrypoint_id", "vault_id"],
+    ),
+    "ix_entrypoints_contract_id_name": ("entrypoints", ["contract_id", "name"]),
+    "ix_outbox_relayer_status_created_at": (
+        "outbox",
+        ["relayer", "status", "created_at"],
+    ),
+}
+
+
+# Whether an index is INVALID, as left by a CREATE INDEX CONCURRENTLY that
+# failed; NULL when it does not exist
+IS_INVALID = sa.text(
+    "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+)
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not lock the tables against writes, but cannot run
+    # in a transaction
+    with op.get_context().autocommit_block():
+        for name, (table, columns) in INDEXES.items():
+            # IF NOT EXISTS would keep an invalid index from a failed run,
+            # which is never used by the planner
+            if op.get_bind().execute(IS_INVALID, {"name": name}).scalar():
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, (table, _) in INDEXES.items():
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
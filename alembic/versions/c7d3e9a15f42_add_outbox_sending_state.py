@@ -0,0 +1,37 @@
+"""add-outbox-sending-state
+
+Revision ID: c7d3e9a15f42
+Revises: 9e4c7a2d1b85
+Create Date: 2026-10-19 10:02:37.514226
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c7d3e9a15f42"
+down_revision: Union[str, None] = "9e4c7a2d1b85"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Before PostgreSQL 12, a value cannot be added to an enum type in a
+    # transaction
+    with op.get_context().autocommit_block():
+        op.execute(
+            "ALTER TYPE outboxstatus ADD VALUE IF NOT EXISTS 'SENDING' AFTER 'PENDING'"
+        )
+    op.add_column("outbox", sa.Column("counter", sa.BigInteger(), nullable=True))
+    op.add_column("outbox", sa.Column("expiry_level", sa.Integer(), nullable=True))
+    op.create_index("ix_outbox_hash", "outbox", ["hash"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_outbox_hash", table_name="outbox")
+    op.drop_column("outbox", "expiry_level")
+    op.drop_column("outbox", "counter")
+    # PostgreSQL cannot remove a value from an enum type: SENDING stays
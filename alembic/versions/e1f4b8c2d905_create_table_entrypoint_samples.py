@@ -0,0 +1,45 @@
+"""create-table-entrypoint-samples
+
+Revision ID: e1f4b8c2d905
+Revises: c7d3e9a15f42
+Create Date: 2026-10-19 11:26:08.904573
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e1f4b8c2d905"
+down_revision: Union[str, None] = "c7d3e9a15f42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "entrypoint_samples",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("contract_address", sa.String(), nullable=False),
+        sa.Column("entrypoint", sa.String(), nullable=False),
+        sa.Column("gas", sa.Integer(), nullable=False),
+        sa.Column("storage", sa.Integer(), nullable=False),
+        sa.Column("fee", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_entrypoint_samples_contract_address_entrypoint_created_at",
+        "entrypoint_samples",
+        ["contract_address", "entrypoint", "created_at"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        "ix_entrypoint_samples_contract_address_entrypoint_created_at",
+        table_name="entrypoint_samples",
+    )
+    op.drop_table("entrypoint_samples")
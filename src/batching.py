@@ -0,0 +1,224 @@
+"""Batch building, shared by the relayers of `tezos`.
+
+This module does not read the configuration nor open any client or database
+connection: the node is only reached through the arguments.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+
+from pytezos.operation import MAX_OPERATIONS_TTL
+from pytezos.rpc.errors import RpcError
+
+
+class SimulationCache:
+    """Keeps the autofilled operation groups of the last `max_size` simulated
+    calls, keyed by the destination, entrypoint and parameters of their
+    operations. Entries are only valid in the scope (head level or protocol)
+    they were simulated in, and are all dropped when it changes."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.scope = None
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def key(operations):
+        key = []
+        for operation in operations:
+            parameters = operation["parameters"]
+            value = json.dumps(parameters.get("value"), sort_keys=True)
+            key.append(
+                (
+                    operation["destination"],
+                    parameters["entrypoint"],
+                    hashlib.sha256(value.encode()).hexdigest(),
+                )
+            )
+        return tuple(key)
+
+    def set_scope(self, scope):
+        if scope != self.scope:
+            self.scope = scope
+            self.entries.clear()
+
+    def get(self, scope, key):
+        self.set_scope(scope)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, scope, key, value):
+        # Without a known scope, nothing tells when the entry gets stale
+        if self.max_size <= 0 or scope is None:
+            return
+        self.set_scope(scope)
+        self.entries[key] = value
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def error_ids(error: RpcError):
+    """Returns the ids of the node errors carried by an RpcError, e.g.
+    "proto.018-Proxford.contract.balance_too_low"."""
+    ids = []
+    for arg in error.args:
+        for e in arg if isinstance(arg, list) else [arg]:
+            if isinstance(e, dict) and "id" in e:
+                ids.append(e["id"])
+    return ids
+
+
+# Last part of the ids of the errors about the counter of the relayer
+COUNTER_ERRORS = ("counter_in_the_past", "counter_in_the_future")
+# Last part of the ids of the errors refusing an operation because another one
+# of the same manager is already in the mempool
+CONFLICT_ERRORS = ("operation_conflict", "manager_restriction")
+
+
+def has_error(error: RpcError, names):
+    return any(id.split(".")[-1] in names for id in error_ids(error))
+
+
+def is_counter_error(error: RpcError):
+    return has_error(error, COUNTER_ERRORS)
+
+
+def is_conflict_error(error: RpcError):
+    return has_error(error, CONFLICT_ERRORS)
+
+
+def is_operation_error(error: RpcError):
+    """Whether the error is caused by the operations themselves, and not by
+    the node (no error id) or by the counter of the relayer."""
+    return (
+        len(error_ids(error)) > 0
+        and not is_counter_error(error)
+        and not is_conflict_error(error)
+    )
+
+
+def validate_operations(simulate, accepted, candidates, simulated=None):
+    """Greedily extends `accepted` with the `candidates` that can be applied
+    together, both being lists of (key, operation) in queue order.
+    The whole batch is simulated once and only bisected on failure, so
+    k conflicting operations cost O(k log n) simulations instead of one
+    simulation per candidate.
+    `simulate` returns the autofilled operation group of a list of
+    operations; `simulated` is the one of `accepted`. Only the errors caused
+    by the operations are bisected: the others fail the whole batch.
+    Returns the accepted operations, their autofilled operation group (None
+    if nothing is accepted) and a list of (key, error) for the rejected
+    ones."""
+    if len(candidates) == 0:
+        return accepted, simulated, []
+    try:
+        operations = accepted + candidates
+        return operations, simulate([op for _, op in operations]), []
+    except RpcError as e:
+        # MichelsonError, TezArithmeticError (balance_too_low,
+        # subtraction_underflow...) or any other error about an operation
+        if not is_operation_error(e):
+            raise
+        if len(candidates) == 1:
+            return accepted, simulated, [(candidates[0][0], e)]
+    middle = len(candidates) // 2
+    accepted, simulated, rejected_left = validate_operations(
+        simulate, accepted, candidates[:middle], simulated
+    )
+    accepted, simulated, rejected_right = validate_operations(
+        simulate, accepted, candidates[middle:], simulated
+    )
+    return accepted, simulated, rejected_left + rejected_right
+
+
+def operation_limits(operation):
+    """Returns the gas limit, storage limit and forged size (in bytes,
+    without the branch) of an autofilled operation group."""
+    gas_limit = sum(int(content.get("gas_limit", 0)) for content in operation.contents)
+    storage_limit = sum(
+        int(content.get("storage_limit", 0)) for content in operation.contents
+    )
+    size = len(bytes.fromhex(operation.forge())) - 32
+    return gas_limit, storage_limit, size
+
+
+def pack_operations(operations, senders, constants):
+    """Selects, in queue order, the (key, operation) that fit together in
+    one operation group without exceeding the protocol limits on gas,
+    storage and operation size. The others are left for a later batch.
+    `senders` maps each key to its sender: once an operation is postponed,
+    the following ones of the same sender are postponed too so that each
+    sender's operations are sent in order.
+    `constants` are the protocol constants holding the limits.
+    The first operation is always selected so that nothing waits forever."""
+    max_gas = int(constants["hard_gas_limit_per_operation"])
+    max_storage = int(constants["hard_storage_limit_per_operation"])
+    max_size = int(constants["max_operation_data_length"])
+    # The branch and the signature are forged once per group
+    gas, storage, size = 0, 0, 32 + 64
+    packed = []
+    postponed_senders = set()
+    for key, operation in operations:
+        if senders[key] in postponed_senders:
+            continue
+        op_gas, op_storage, op_size = operation_limits(operation)
+        if len(packed) > 0 and (
+            gas + op_gas > max_gas
+            or storage + op_storage > max_storage
+            or size + op_size > max_size
+        ):
+            postponed_senders.add(senders[key])
+            continue
+        gas, storage, size = gas + op_gas, storage + op_storage, size + op_size
+        packed.append((key, operation))
+    return packed
+
+
+class CounterManager:
+    """Tracks locally the counter of a relayer, and the branch to use for the
+    current head, instead of asking the node before each simulation and
+    injection."""
+
+    def __init__(self, client):
+        self.client = client
+        self.counter = None  # Last counter used by the relayer
+        self.level = None
+        self.branch = None
+        # Last level at which an operation on the current branch can be
+        # included
+        self.expiry_level = None
+
+    def chain_counter(self):
+        """Last counter of the relayer included on chain."""
+        address = self.client.key.public_key_hash()
+        return int(self.client.shell.contracts[address]()["counter"])
+
+    def resync(self):
+        self.counter = self.chain_counter()
+        logging.debug(
+            f"Counter of {self.client.key.public_key_hash()} is {self.counter}"
+        )
+
+    def next_counter(self):
+        if self.counter is None:
+            self.resync()
+        return self.counter + 1
+
+    def injected(self, nb_contents):
+        self.counter = self.next_counter() + nb_contents - 1
+
+    def set_head(self, level):
+        """Caches the branch for a new head; as pytezos does, operations are
+        branched on an older block so that they expire after the default
+        ttl."""
+        if level == self.level:
+            return
+        ttl = self.client.context.get_operations_ttl()
+        self.branch = self.client.shell.blocks[
+            level - (MAX_OPERATIONS_TTL - ttl)
+        ].hash()
+        self.level = level
+        self.expiry_level = level + ttl
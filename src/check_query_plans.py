@@ -0,0 +1,74 @@
+"""Query plan check, run with `python -m src.check_query_plans`.
+
+Explains the queries run on every request and exits with an error if one
+of them is planned with a sequential scan. Sequential scans are disabled
+while planning, so that an existing index is used even on a small table:
+any remaining one means that no index matches the query.
+"""
+import sys
+
+from sqlalchemy import text
+
+from . import database
+
+
+ID = "'00000000-0000-0000-0000-000000000000'"
+
+QUERIES = {
+    "operation by hash": "SELECT * FROM operations WHERE hash = 'oo'",
+    "sponsee condition": (
+        "SELECT * FROM conditions WHERE type = 'MAX_CALLS_PER_SPONSEE'"
+        f" AND sponsee_address = 'tz1' AND vault_id = {ID}"
+    ),
+    "entrypoint condition": (
+        "SELECT * FROM conditions WHERE type = 'MAX_CALLS_PER_ENTRYPOINT'"
+        f" AND contract_id = {ID} AND entrypoint_id = {ID} AND vault_id = {ID}"
+    ),
+    "entrypoint by name": (
+        f"SELECT * FROM entrypoints WHERE contract_id = {ID} AND name = 'default'"
+    ),
+    "monthly calls": (
+        "SELECT calls FROM monthly_calls"
+        f" WHERE contract_id = {ID} AND month = '2024-01-01'"
+    ),
+    "pending outbox operations": (
+        "SELECT * FROM outbox WHERE relayer = 'tz1' AND status = 'PENDING'"
+        " ORDER BY created_at FOR UPDATE SKIP LOCKED"
+    ),
+    "queued outbox operations": (
+        "SELECT relayer, count(*) FROM outbox WHERE relayer IN ('tz1')"
+        " AND status IN ('PENDING', 'SENDING') GROUP BY relayer"
+    ),
+    "queued outbox operations of a vault": (
+        f"SELECT count(*) FROM outbox WHERE vault_id = {ID}"
+        " AND status IN ('PENDING', 'SENDING')"
+    ),
+}
+
+
+def seq_scans(plan):
+    """Returns the tables read with a sequential scan in a JSON plan."""
+    tables = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for subplan in plan.get("Plans", []):
+        tables += seq_scans(subplan)
+    return tables
+
+
+def check():
+    failures = []
+    with database.lock_engine.connect() as connection:
+        with connection.begin():
+            connection.execute(text("SET LOCAL enable_seqscan = off"))
+            for name, query in QUERIES.items():
+                [[result]] = connection.execute(text(f"EXPLAIN (FORMAT JSON) {query}"))
+                tables = seq_scans(result[0]["Plan"])
+                if len(tables) > 0:
+                    failures.append(name)
+                    print(f"{name}: sequential scan on {', '.join(tables)}")
+                else:
+                    print(f"{name}: ok")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if len(check()) > 0 else 0)
@@ -5,9 +5,62 @@ import logging
 
 load_dotenv(override=True)
 
-TEZOS_RPC = os.getenv("TEZOS_RPC")
+# Tezos nodes, comma separated; injections go to TEZOS_INJECTION_RPC if
+# given, and to all the nodes otherwise
+TEZOS_RPC = [
+    uri.strip() for uri in os.getenv("TEZOS_RPC", "").split(",") if len(uri.strip()) > 0
+]
+TEZOS_INJECTION_RPC = [
+    uri.strip()
+    for uri in os.getenv("TEZOS_INJECTION_RPC", "").split(",")
+    if len(uri.strip()) > 0
+]
 SECRET_KEY_CMD = os.getenv("SECRET_KEY_CMD")
 LEVEL = os.getenv("LEVEL", logging.INFO)
+# Maximum time (in seconds) a caller waits for its operation to be injected
+MAX_WAITING_TIME = float(os.getenv("MAX_WAITING_TIME", 120))
+# Run the batching loop inside the API process; set to false when it runs
+# in a separate worker (`python -m src.worker`)
+EMBEDDED_BATCHER = os.getenv("EMBEDDED_BATCHER", "true").lower() == "true"
+# Number of threads running the blocking RPC calls, which is also the
+# number of keep-alive connections kept open to the node
+RPC_THREADS = int(os.getenv("RPC_THREADS", 8))
+# Time (in seconds) a failing node is left aside, and number of blocks a
+# node can lag behind the others before it is left aside too
+RPC_EJECTION_TIME = float(os.getenv("RPC_EJECTION_TIME", 30))
+RPC_MAX_LAG = int(os.getenv("RPC_MAX_LAG", 2))
+# Number of simulated calls whose estimates are reused for identical calls
+# (0 disables the cache), until the head or the protocol changes depending
+# on SIMULATION_CACHE_SCOPE ("head" or "protocol")
+SIMULATION_CACHE_SIZE = int(os.getenv("SIMULATION_CACHE_SIZE", 0))
+SIMULATION_CACHE_SCOPE = os.getenv("SIMULATION_CACHE_SCOPE", "head")
+# Estimate the calls of well-known entrypoints from the receipts of their
+# last ENTRYPOINT_PROFILE_WINDOW calls, once there are at least
+# ENTRYPOINT_PROFILE_MIN_SAMPLES of them, instead of simulating them
+ENTRYPOINT_PROFILES = os.getenv("ENTRYPOINT_PROFILES", "false").lower() == "true"
+ENTRYPOINT_PROFILE_WINDOW = int(os.getenv("ENTRYPOINT_PROFILE_WINDOW", 200))
+ENTRYPOINT_PROFILE_MIN_SAMPLES = int(os.getenv("ENTRYPOINT_PROFILE_MIN_SAMPLES", 50))
+# Time (in seconds) an account is known as not revealed before its public
+# key is looked up again
+PUBLIC_KEY_NEGATIVE_TTL = float(os.getenv("PUBLIC_KEY_NEGATIVE_TTL", 60))
+# Number of worker processes verifying the signatures
+SIGNATURE_WORKERS = int(os.getenv("SIGNATURE_WORKERS", os.cpu_count() or 1))
+# Number of blocks whose operation hashes are kept in memory
+BLOCK_INDEX_CACHE_SIZE = int(os.getenv("BLOCK_INDEX_CACHE_SIZE", 64))
+# Maximum number of queued operations, and of operations in flight per vault,
+# before POST /operation refuses new ones (0 means no limit). The operations
+# are counted in the outbox, for all the API processes together.
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", 1000))
+MAX_IN_FLIGHT_PER_VAULT = int(os.getenv("MAX_IN_FLIGHT_PER_VAULT", 100))
+# Time (in seconds) the injected, failed and cancelled operations are kept in
+# the outbox (0 keeps them forever), and maximum number of them kept for each
+# relayer (0 means no limit). Only their result is kept, not their contents.
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", 86400))
+OUTBOX_MAX_FINISHED = int(os.getenv("OUTBOX_MAX_FINISHED", 100000))
+# Interval (in seconds) between two polls of the node head
+HEAD_POLLING_INTERVAL = float(os.getenv("HEAD_POLLING_INTERVAL", 1))
+# Delay (in seconds) after a new block before the batch is sent
+BATCH_OFFSET = float(os.getenv("BATCH_OFFSET", 2))
 
 if SECRET_KEY_CMD is not None:
     command = SECRET_KEY_CMD.split()
@@ -17,7 +70,19 @@ else:
     SECRET_KEY = os.getenv("SECRET_KEY")
 
 
-assert TEZOS_RPC is not None, "Please specify a TEZOS_RPC"
+# Additional relayer keys, comma separated; each one gets its own batch queue
+RELAYER_SECRET_KEYS = [
+    key.strip()
+    for key in os.getenv("RELAYER_SECRET_KEYS", "").split(",")
+    if len(key.strip()) > 0
+]
+
+assert len(TEZOS_RPC) > 0, "Please specify a TEZOS_RPC"
+assert all(
+    uri in TEZOS_RPC for uri in TEZOS_INJECTION_RPC
+), "TEZOS_INJECTION_RPC must be a subset of TEZOS_RPC"
+assert SIGNATURE_WORKERS >= 1, "SIGNATURE_WORKERS must be at least 1"
+assert SIMULATION_CACHE_SCOPE in ("head", "protocol"), "Unknown SIMULATION_CACHE_SCOPE"
 assert SECRET_KEY is not None and len(SECRET_KEY) > 0, "Could not read secret key"
 
 
@@ -2,7 +2,10 @@ import datetime
 from typing import Optional, List
 from psycopg2.errors import UniqueViolation
 from pydantic import UUID4
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 
 from .utils import (
     ConditionAlreadyExists,
@@ -15,243 +18,295 @@ from .utils import (
 from . import models, schemas
 from sqlalchemy.exc import NoResultFound
 
+# Relationships serialized with a contract: async sessions cannot load them
+# lazily.
+contract_options = [
+    selectinload(models.Contract.entrypoints),
+    selectinload(models.Contract.credit),
+]
 
-def get_user(db: Session, uuid: UUID4):
+# Channel on which the changes of the contracts and of their entrypoints are
+# published, for the registry of each process: the payload is the address of
+# the contract, or empty for all of them.
+REGISTRY_CHANNEL = "registry"
+
+
+def notify(db: Session, channel: str, payload: str):
+    """
+    Send a notification to the listeners of `channel` when the current
+    transaction commits. Async sessions call it through `db.run_sync`.
+    """
+    db.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": channel, "payload": payload},
+    )
+
+
+async def get_user(db: AsyncSession, uuid: UUID4):
     """
     Return a models.User or raise UserNotFound exception
     """
-    db_user: Optional[models.User] = db.query(models.User).get(uuid)
+    db_user: Optional[models.User] = await db.get(
+        models.User, uuid, options=[selectinload(models.User.credits)]
+    )
     if db_user is None:
         raise UserNotFound()
     return db_user
 
 
-def get_user_by_address(db: Session, address: str):
+async def get_user_by_address(db: AsyncSession, address: str):
     """
     Return a models.User or raise UserNotFound exception
     """
     try:
-        return db.query(models.User).filter(models.User.address == address).one()
+        return (
+            await db.execute(
+                select(models.User)
+                .filter(models.User.address == address)
+                .options(selectinload(models.User.credits))
+            )
+        ).scalar_one()
     except NoResultFound as e:
         raise UserNotFound() from e
 
 
-def create_user(db: Session, user: schemas.UserCreation):
+async def create_user(db: AsyncSession, user: schemas.UserCreation):
     db_user = models.User(**user.model_dump())
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
-def get_contracts_by_user(db: Session, user_address: str):
+async def update_user_public_key(db: AsyncSession, user_id: str, public_key: str):
+    await db.execute(
+        update(models.User)
+        .where(models.User.id == user_id)
+        .values({"public_key": public_key})
+    )
+    await db.commit()
+
+
+async def get_contracts_by_user(db: AsyncSession, user_address: str):
     """
     Return a list of models.Contracts or raise UserNotFound exception
     """
-    user = get_user_by_address(db, user_address)
-    return user.contracts
+    user = await get_user_by_address(db, user_address)
+    return (
+        (
+            await db.execute(
+                select(models.Contract)
+                .filter(models.Contract.owner_id == user.id)
+                .options(*contract_options)
+            )
+        )
+        .scalars()
+        .all()
+    )
 
 
-def get_contracts_by_credit(db: Session, credit_id: str):
+async def get_contracts_by_credit(db: AsyncSession, credit_id: str):
     """
     Return a list of models.Contracts or raise UserNotFound exception
     """
     return (
-        db.query(models.Contract).filter(models.Contract.credit_id == credit_id).all()
+        (
+            await db.execute(
+                select(models.Contract)
+                .filter(models.Contract.credit_id == credit_id)
+                .options(*contract_options)
+            )
+        )
+        .scalars()
+        .all()
     )
 
 
-def get_contract_by_address(db: Session, address: str):
+async def get_contract_by_address(db: AsyncSession, address: str):
     """
     Return a models.Contract or raise ContractNotFound exception
     """
     try:
         return (
-            db.query(models.Contract).filter(models.Contract.address == address).one()
-        )
+            await db.execute(
+                select(models.Contract)
+                .filter(models.Contract.address == address)
+                .options(*contract_options)
+            )
+        ).scalar_one()
     except NoResultFound as e:
         raise ContractNotFound() from e
 
 
-def get_contract(db: Session, contract_id: str):
+async def get_contract(db: AsyncSession, contract_id: str):
     """
     Return a models.Contract or raise ContractNotFound exception
     """
-    db_contract: Optional[models.Contract] = db.query(models.Contract).get(contract_id)
+    db_contract: Optional[models.Contract] = await db.get(
+        models.Contract, contract_id, options=contract_options
+    )
     if db_contract is None:
         raise ContractNotFound()
     return db_contract
 
 
-def get_entrypoints(
-    db: Session, contract_address_or_id: str
+async def get_entrypoints(
+    db: AsyncSession, contract_address_or_id: str
 ) -> List[models.Entrypoint]:
     """
     Return a list of models.Contract or raise ContractNotFound exception
     """
     if contract_address_or_id.startswith("KT"):
-        contract = get_contract_by_address(db, contract_address_or_id)
+        contract = await get_contract_by_address(db, contract_address_or_id)
     else:
-        contract = get_contract(db, contract_address_or_id)
+        contract = await get_contract(db, contract_address_or_id)
     return contract.entrypoints
 
 
-def get_entrypoint(db: Session, contract_address_or_id: str, name: str):
+async def get_entrypoint(db: AsyncSession, contract_address_or_id: str, name: str):
     """
     Return a models.Entrypoint or raise EntrypointNotFound exception
     """
-    entrypoints = get_entrypoints(db, contract_address_or_id)
+    entrypoints = await get_entrypoints(db, contract_address_or_id)
     entrypoint = [e for e in entrypoints if e.name == name]  # type: ignore
     if len(entrypoint) == 0:
         raise EntrypointNotFound()
     return entrypoint[0]
 
 
-def create_contract(db: Session, contract: schemas.ContractCreation):
+async def create_contract(db: AsyncSession, contract: schemas.ContractCreation):
     # TODO rewrite this with transaction or something else better
     try:
-        contract = get_contract_by_address(db, contract.address)
+        contract = await get_contract_by_address(db, contract.address)
         raise ContractAlreadyRegistered(f"Contract {contract.address} already added.")
     except ContractNotFound:
         c = {k: v for k, v in contract.model_dump().items() if k not in ["entrypoints"]}
         db_contract = models.Contract(**c)
         db.add(db_contract)
-        db.commit()
-        db.refresh(db_contract)
+        await db.commit()
+        await db.refresh(db_contract)
         db_entrypoints = [
             models.Entrypoint(**e.model_dump(), contract_id=db_contract.id)
             for e in contract.entrypoints
         ]
         db.add_all(db_entrypoints)
-        db.commit()
+        await db.run_sync(notify, REGISTRY_CHANNEL, db_contract.address)
+        await db.commit()
+        await db.refresh(db_contract, attribute_names=["entrypoints", "credit"])
         return db_contract
 
 
-def update_entrypoints(db: Session, entrypoints: list[schemas.EntrypointUpdate]):
+async def update_entrypoints(
+    db: AsyncSession, entrypoints: list[schemas.EntrypointUpdate]
+):
     for e in entrypoints:
-        db.query(models.Entrypoint).filter(models.Entrypoint.id == e.id).update(
-            {"is_enabled": e.is_enabled}
+        await db.execute(
+            update(models.Entrypoint)
+            .where(models.Entrypoint.id == e.id)
+            .values({"is_enabled": e.is_enabled})
         )
-    db.commit()
+    await db.run_sync(notify, REGISTRY_CHANNEL, "")
+    await db.commit()
     entrypoints_ids = list(map(lambda e: e.id, entrypoints))
     return (
-        db.query(models.Entrypoint)
-        .filter(models.Entrypoint.id.in_(entrypoints_ids))
+        (
+            await db.execute(
+                select(models.Entrypoint).filter(
+                    models.Entrypoint.id.in_(entrypoints_ids)
+                )
+            )
+        )
+        .scalars()
         .all()
     )
 
 
-def get_user_credits(db: Session, user_id: str):
+async def get_user_credits(db: AsyncSession, user_id: str):
     """
     Get credits from a user.
     """
-    db_credits = db.query(models.Credit).filter(models.Credit.owner_id == user_id).all()
+    db_credits = (
+        (
+            await db.execute(
+                select(models.Credit).filter(models.Credit.owner_id == user_id)
+            )
+        )
+        .scalars()
+        .all()
+    )
     return db_credits
 
 
-def update_user_withdraw_counter(db: Session, user_id: str, withdraw_counter: int):
-    try:
-        db_user: Optional[models.User] = db.query(models.User).get(user_id)
-        if db_user is None:
-            raise UserNotFound()
-
-        db.query(models.User).filter(models.User.id == user_id).update(
-            {"withdraw_counter": withdraw_counter}
-        )
-
-        db.commit()
-        return db_user.withdraw_counter
-    except NoResultFound as e:
-        raise UserNotFound from e
+async def update_user_withdraw_counter(
+    db: AsyncSession, user_id: str, withdraw_counter: int
+):
+    db_user: Optional[models.User] = await db.get(models.User, user_id)
+    if db_user is None:
+        raise UserNotFound()
+    db_user.withdraw_counter = withdraw_counter
+    await db.commit()
+    return db_user.withdraw_counter
 
 
-def create_credits(db: Session, credit: schemas.CreditCreation):
+async def create_credits(db: AsyncSession, credit: schemas.CreditCreation):
     """
     Creates credits for a given owner and returns a models.Credit.
     """
-    try:
-        # Check if the user exists
-        _ = db.query(models.User).get(credit.owner_id)
-        credit = models.Credit(**credit.model_dump())
-        db.add(credit)
-        db.commit()
-        # db.refresh(credit)
-        return credit
-    except NoResultFound as e:
-        raise UserNotFound() from e
+    # Check if the user exists
+    if await db.get(models.User, credit.owner_id) is None:
+        raise UserNotFound()
+    credit = models.Credit(**credit.model_dump())
+    db.add(credit)
+    await db.commit()
+    return credit
 
 
-def update_credits(db: Session, credit_update: schemas.CreditUpdate):
+async def update_credits(db: AsyncSession, credit_update: schemas.CreditUpdate):
     """
     Update a credit row and return a models.Credit. \n
     Can raise a ContractNotFound exception or CreditNotFound exception.
     """
-    try:
-        amount = credit_update.amount
-        db_credit: Optional[models.Credit] = db.query(models.Credit).get(
-            credit_update.id
-        )
-        if db_credit is None:
-            raise CreditNotFound()
-        db.query(models.Credit).filter(models.Credit.id == credit_update.id).update(
-            {"amount": db_credit.amount + amount}
-        )
-        db.commit()
-        return db_credit
-    except NoResultFound as e:
-        raise CreditNotFound() from e
-
-
-def update_credits_from_contract_address(db: Session, amount: int, address: str):
-    try:
-        db_contract: Optional[models.Credit] = (
-            db.query(models.Contract)
-            .filter(models.Contract.address == address)
-            .one_or_none()
-        )
-        if db_contract is None:
-            raise ContractNotFound()
-        db.query(models.Credit).filter(
-            models.Credit.id == db_contract.credit_id
-        ).update({"amount": db_contract.credit.amount + amount})
-        db.commit()
-        return db_contract.credit
-    except NoResultFound as e:
-        raise CreditNotFound() from e
+    amount = credit_update.amount
+    db_credit: Optional[models.Credit] = await db.get(models.Credit, credit_update.id)
+    if db_credit is None:
+        raise CreditNotFound()
+    await db.execute(
+        update(models.Credit)
+        .where(models.Credit.id == credit_update.id)
+        .values({"amount": models.Credit.amount + amount})
+    )
+    await db.commit()
+    await db.refresh(db_credit)
+    return db_credit
 
 
-def get_credits(db: Session, uuid: UUID4):
+async def get_credits(db: AsyncSession, uuid: UUID4):
     """
     Return a models.Credit or raise UserNotFound exception
     """
-    db_credit = db.query(models.Credit).get(uuid)
+    db_credit = await db.get(
+        models.Credit, uuid, options=[selectinload(models.Credit.owner)]
+    )
     if db_credit is None:
         raise CreditNotFound()
     return db_credit
 
 
-def get_credits_from_contract_address(db: Session, contract_address: str):
-    try:
-        db_contract = (
-            db.query(models.Contract)
-            .filter(models.Contract.address == contract_address)
-            .one_or_none()
+async def get_credits_from_contract_address(db: AsyncSession, contract_address: str):
+    db_contract = (
+        await db.execute(
+            select(models.Contract).filter(models.Contract.address == contract_address)
         )
-        if db_contract is None:
-            raise ContractNotFound()
-        db_credit = (
-            db.query(models.Credit)
-            .filter(models.Credit.id == db_contract.credit_id)
-            .one_or_none()
-        )
-        if db_credit is None:
-            raise CreditNotFound()
-        return db_credit
-    except NoResultFound as e:
-        raise ContractNotFound() from e
+    ).scalar_one_or_none()
+    if db_contract is None:
+        raise ContractNotFound()
+    db_credit = await db.get(models.Credit, db_contract.credit_id)
+    if db_credit is None:
+        raise CreditNotFound()
+    return db_credit
 
 
-def create_operation(db: Session, operation: schemas.CreateOperation):
+async def create_operation(db: AsyncSession, operation: schemas.CreateOperation):
     db_operation = models.Operation(
         **{
             "user_address": operation.user_address,
@@ -262,66 +317,72 @@ def create_operation(db: Session, operation: schemas.CreateOperation):
         }
     )
     db.add(db_operation)
-    db.commit()
-    db.refresh(db_operation)
+    # Counted in the same transaction, atomically for concurrent requests
+    await db.execute(
+        insert(models.MonthlyCalls)
+        .values(contract_id=operation.contract_id, month=current_month(), calls=1)
+        .on_conflict_do_update(
+            index_elements=["contract_id", "month"],
+            set_={"calls": models.MonthlyCalls.calls + 1},
+        )
+    )
+    await db.commit()
+    await db.refresh(db_operation)
     return db_operation
 
 
-def update_amount_operation(db: Session, hash: str, amount: int):
-    db.query(models.Operation).filter(models.Operation.hash == hash).update(
-        {"cost": amount}
-    )
-    db.commit()
+def current_month():
+    return datetime.date.today().replace(day=1)
 
 
-def get_operations_by_contracts_per_month(db: Session, contract_id):
-    first_day_of_month = datetime.datetime.today().replace(
-        day=1, hour=0, minute=0, second=0, microsecond=0
-    )
-    db_operations = (
-        db.query(models.Operation)
-        .filter(models.Operation.contract_id == contract_id)
-        .filter(models.Operation.created_at >= first_day_of_month)
-        .all()
-    )
-    return db_operations
+async def get_calls_per_month(db: AsyncSession, contract_id):
+    calls = (
+        await db.execute(
+            select(models.MonthlyCalls.calls)
+            .filter(models.MonthlyCalls.contract_id == contract_id)
+            .filter(models.MonthlyCalls.month == current_month())
+        )
+    ).scalar_one_or_none()
+    return calls or 0
 
 
-def get_max_calls_per_month_by_contract_address(db: Session, contract_id):
-    contract = get_contract(db, contract_id)
+async def get_max_calls_per_month_by_contract_address(db: AsyncSession, contract_id):
+    contract = await get_contract(db, contract_id)
     return contract.max_calls_per_month
 
 
-def update_max_calls_per_month_condition(db: Session, max_calls: int, contract_id):
-    db_contract = get_contract(db, contract_id)
-    db.query(models.Contract).filter(models.Contract.id == contract_id).update(
-        {"max_calls_per_month": max_calls}
-    )
-    db.commit()
-    # db_contract.refresh()
+async def update_max_calls_per_month_condition(
+    db: AsyncSession, max_calls: int, contract_id
+):
+    db_contract = await get_contract(db, contract_id)
+    db_contract.max_calls_per_month = max_calls
+    await db.run_sync(notify, REGISTRY_CHANNEL, db_contract.address)
+    await db.commit()
     return db_contract
 
 
-def check_calls_per_month(db, contract_id):
-    max_calls = get_max_calls_per_month_by_contract_address(db, contract_id)
+async def check_calls_per_month(db, contract_id, max_calls=None):
+    if max_calls is None:
+        max_calls = await get_max_calls_per_month_by_contract_address(db, contract_id)
     # If max_calls is -1 means condition is disabled (NO LIMIT)
     if max_calls == -1:  # type: ignore
         return True
-    nb_operations_already_made = get_operations_by_contracts_per_month(db, contract_id)
-    return max_calls >= len(nb_operations_already_made)
+    nb_operations_already_made = await get_calls_per_month(db, contract_id)
+    return max_calls >= nb_operations_already_made
 
 
-def create_max_calls_per_sponsee_condition(
-    db: Session, condition: schemas.CreateMaxCallsPerSponseeCondition
+async def create_max_calls_per_sponsee_condition(
+    db: AsyncSession, condition: schemas.CreateMaxCallsPerSponseeCondition
 ):
     # If a condition still exists, do not create a new one
     existing_condition = (
-        db.query(models.Condition)
-        .filter(models.Condition.sponsee_address == condition.sponsee_address)
-        .filter(models.Condition.vault_id == condition.vault_id)
-        .filter(models.Condition.current < models.Condition.max)
-        .one_or_none()
-    )
+        await db.execute(
+            select(models.Condition)
+            .filter(models.Condition.sponsee_address == condition.sponsee_address)
+            .filter(models.Condition.vault_id == condition.vault_id)
+            .filter(models.Condition.current < models.Condition.max)
+        )
+    ).scalar_one_or_none()
     if existing_condition is not None:
         raise ConditionAlreadyExists(
             "A condition with maximum calls per sponsee already exists and the maximum is not reached. Cannot create a new one."
@@ -336,8 +397,8 @@ def create_max_calls_per_sponsee_condition(
         }
     )
     db.add(db_condition)
-    db.commit()
-    db.refresh(db_condition)
+    await db.commit()
+    await db.refresh(db_condition)
     return schemas.MaxCallsPerSponseeCondition(
         sponsee_address=db_condition.sponsee_address,
         vault_id=db_condition.vault_id,
@@ -349,18 +410,19 @@ def create_max_calls_per_sponsee_condition(
     )
 
 
-def create_max_calls_per_entrypoint_condition(
-    db: Session, condition: schemas.CreateMaxCallsPerEntrypointCondition
+async def create_max_calls_per_entrypoint_condition(
+    db: AsyncSession, condition: schemas.CreateMaxCallsPerEntrypointCondition
 ):
     # If a condition still exists, do not create a new one
     existing_condition = (
-        db.query(models.Condition)
-        .filter(models.Condition.entrypoint_id == condition.entrypoint_id)
-        .filter(models.Condition.contract_id == condition.contract_id)
-        .filter(models.Condition.vault_id == condition.vault_id)
-        .filter(models.Condition.current < models.Condition.max)
-        .one_or_none()
-    )
+        await db.execute(
+            select(models.Condition)
+            .filter(models.Condition.entrypoint_id == condition.entrypoint_id)
+            .filter(models.Condition.contract_id == condition.contract_id)
+            .filter(models.Condition.vault_id == condition.vault_id)
+            .filter(models.Condition.current < models.Condition.max)
+        )
+    ).scalar_one_or_none()
     if existing_condition is not None:
         raise ConditionAlreadyExists(
             "A condition with maximum calls per entrypoint already exists and the maximum is not reached. Cannot create a new one."
@@ -376,8 +438,8 @@ def create_max_calls_per_entrypoint_condition(
         }
     )
     db.add(db_condition)
-    db.commit()
-    db.refresh(db_condition)
+    await db.commit()
+    await db.refresh(db_condition)
     return schemas.MaxCallsPerEntrypointCondition(
         contract_id=db_condition.contract_id,
         entrypoint_id=db_condition.entrypoint_id,
@@ -390,35 +452,43 @@ def create_max_calls_per_entrypoint_condition(
     )
 
 
-def check_max_calls_per_sponsee(db: Session, sponsee_address: str, vault_id: UUID4):
+async def check_max_calls_per_sponsee(
+    db: AsyncSession, sponsee_address: str, vault_id: UUID4
+):
     return (
-        db.query(models.Condition)
-        .filter(models.Condition.type == schemas.ConditionType.MAX_CALLS_PER_SPONSEE)
-        .filter(models.Condition.sponsee_address == sponsee_address)
-        .filter(models.Condition.vault_id == vault_id)
-        .one_or_none()
-    )
+        await db.execute(
+            select(models.Condition)
+            .filter(
+                models.Condition.type == schemas.ConditionType.MAX_CALLS_PER_SPONSEE
+            )
+            .filter(models.Condition.sponsee_address == sponsee_address)
+            .filter(models.Condition.vault_id == vault_id)
+        )
+    ).scalar_one_or_none()
 
 
-def check_max_calls_per_entrypoint(
-    db: Session, contract_id: UUID4, entrypoint_id: UUID4, vault_id: UUID4
+async def check_max_calls_per_entrypoint(
+    db: AsyncSession, contract_id: UUID4, entrypoint_id: UUID4, vault_id: UUID4
 ):
     return (
-        db.query(models.Condition)
-        .filter(models.Condition.type == schemas.ConditionType.MAX_CALLS_PER_ENTRYPOINT)
-        .filter(models.Condition.contract_id == contract_id)
-        .filter(models.Condition.entrypoint_id == entrypoint_id)
-        .filter(models.Condition.vault_id == vault_id)
-        .one_or_none()
-    )
+        await db.execute(
+            select(models.Condition)
+            .filter(
+                models.Condition.type == schemas.ConditionType.MAX_CALLS_PER_ENTRYPOINT
+            )
+            .filter(models.Condition.contract_id == contract_id)
+            .filter(models.Condition.entrypoint_id == entrypoint_id)
+            .filter(models.Condition.vault_id == vault_id)
+        )
+    ).scalar_one_or_none()
 
 
-def check_conditions(db: Session, datas: schemas.CheckConditions):
+async def check_conditions(db: AsyncSession, datas: schemas.CheckConditions):
     print(datas)
-    sponsee_condition = check_max_calls_per_sponsee(
+    sponsee_condition = await check_max_calls_per_sponsee(
         db, datas.sponsee_address, datas.vault_id
     )
-    entrypoint_condition = check_max_calls_per_entrypoint(
+    entrypoint_condition = await check_max_calls_per_entrypoint(
         db, datas.contract_id, datas.entrypoint_id, datas.vault_id
     )
 
@@ -439,19 +509,348 @@ def check_conditions(db: Session, datas: schemas.CheckConditions):
     # TODO - Rewrite with list
 
     if sponsee_condition:
-        update_condition(db, sponsee_condition)
+        await update_condition(db, sponsee_condition)
     if entrypoint_condition:
-        update_condition(db, entrypoint_condition)
+        await update_condition(db, entrypoint_condition)
     return True
 
 
-def update_condition(db: Session, condition: models.Condition):
-    db.query(models.Condition).filter(models.Condition.id == condition.id).update(
-        {"current": condition.current + 1}
+async def update_condition(db: AsyncSession, condition: models.Condition):
+    await db.execute(
+        update(models.Condition)
+        .where(models.Condition.id == condition.id)
+        .values({"current": condition.current + 1})
     )
 
 
-def get_conditions_by_vault(db: Session, vault_id: str):
+async def get_conditions_by_vault(db: AsyncSession, vault_id: str):
     return (
-        db.query(models.Condition).filter(models.Condition.vault_id == vault_id).all()
+        (
+            await db.execute(
+                select(models.Condition).filter(models.Condition.vault_id == vault_id)
+            )
+        )
+        .scalars()
+        .all()
     )
+
+
+async def create_outbox_operation(
+    db: AsyncSession, operation: schemas.CreateOutboxOperation
+):
+    db_operation = models.OutboxOperation(
+        **operation.model_dump(), status=schemas.OutboxStatus.PENDING
+    )
+    db.add(db_operation)
+    await db.commit()
+    return db_operation
+
+
+async def get_outbox_operations(db: AsyncSession, ids: list[UUID4]):
+    """
+    Return the models.OutboxOperation of the given ids.
+    """
+    return (
+        (
+            await db.execute(
+                select(models.OutboxOperation).filter(
+                    models.OutboxOperation.id.in_(ids)
+                )
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+
+async def cancel_outbox_operation(db: AsyncSession, id: UUID4):
+    """
+    Cancel an operation which has not been sent yet.
+    Return False if it was already sent or failed.
+    """
+    result = await db.execute(
+        update(models.OutboxOperation)
+        .where(models.OutboxOperation.id == id)
+        .where(models.OutboxOperation.status == schemas.OutboxStatus.PENDING)
+        .values({"status": schemas.OutboxStatus.CANCELLED, "contents": []})
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+
+QUEUED_OUTBOX_STATUSES = [schemas.OutboxStatus.PENDING, schemas.OutboxStatus.SENDING]
+
+
+async def get_outbox_queue_depths(db: AsyncSession, relayers: list[str]):
+    """
+    Return the number of queued (pending or sending) operations of each of
+    the `relayers` which has some.
+    """
+    rows = (
+        await db.execute(
+            select(models.OutboxOperation.relayer, func.count())
+            .filter(models.OutboxOperation.relayer.in_(relayers))
+            .filter(models.OutboxOperation.status.in_(QUEUED_OUTBOX_STATUSES))
+            .group_by(models.OutboxOperation.relayer)
+        )
+    ).all()
+    return {relayer: count for relayer, count in rows}
+
+
+async def count_vault_outbox_operations(db: AsyncSession, vault_id: UUID4):
+    """
+    Return the number of queued (pending or sending) operations of a vault.
+    """
+    return (
+        await db.execute(
+            select(func.count())
+            .select_from(models.OutboxOperation)
+            .filter(models.OutboxOperation.vault_id == vault_id)
+            .filter(models.OutboxOperation.status.in_(QUEUED_OUTBOX_STATUSES))
+        )
+    ).scalar_one()
+
+
+async def get_relayer_batch_sizes(db: AsyncSession):
+    """
+    Return the size of the last batch sent by each relayer.
+    """
+    rows = (
+        await db.execute(select(models.RelayerBatch.relayer, models.RelayerBatch.size))
+    ).all()
+    return {relayer: size for relayer, size in rows}
+
+
+async def get_entrypoint_samples(db: AsyncSession, window: int):
+    """
+    Return the (contract_address, entrypoint, gas, storage, fee) of the last
+    `window` samples of each entrypoint, oldest first.
+    """
+    ranked = select(
+        models.EntrypointSample,
+        func.row_number()
+        .over(
+            partition_by=(
+                models.EntrypointSample.contract_address,
+                models.EntrypointSample.entrypoint,
+            ),
+            order_by=models.EntrypointSample.created_at.desc(),
+        )
+        .label("rank"),
+    ).subquery()
+    return (
+        await db.execute(
+            select(
+                ranked.c.contract_address,
+                ranked.c.entrypoint,
+                ranked.c.gas,
+                ranked.c.storage,
+                ranked.c.fee,
+            )
+            .filter(ranked.c.rank <= window)
+            .order_by(ranked.c.created_at)
+        )
+    ).all()
+
+
+# The functions below are used by the batcher, which runs in the RPC thread
+# pool: they take a synchronous Session.
+
+
+def claim_outbox_operations(db: Session, relayer: str):
+    """
+    Return the pending models.OutboxOperation of a relayer, oldest first.
+    Rows are locked until the transaction ends; rows already locked by
+    another batcher are skipped.
+    """
+    return (
+        db.query(models.OutboxOperation)
+        .filter(models.OutboxOperation.relayer == relayer)
+        .filter(models.OutboxOperation.status == schemas.OutboxStatus.PENDING)
+        .order_by(models.OutboxOperation.created_at)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def get_sending_outbox_operations(
+    db: Session, relayer: str, hash: Optional[str] = None
+):
+    """
+    Return the models.OutboxOperation of a relayer whose batch was signed
+    but whose injection is not confirmed, optionally only those of the
+    batch `hash`.
+    """
+    query = (
+        db.query(models.OutboxOperation)
+        .filter(models.OutboxOperation.relayer == relayer)
+        .filter(models.OutboxOperation.status == schemas.OutboxStatus.SENDING)
+    )
+    if hash is not None:
+        query = query.filter(models.OutboxOperation.hash == hash)
+    return query.all()
+
+
+def send_outbox_operation(
+    db: Session,
+    id: UUID4,
+    hash: str,
+    batch_index: int,
+    counter: int,
+    expiry_level: int,
+):
+    db.query(models.OutboxOperation).filter(models.OutboxOperation.id == id).update(
+        {
+            "status": schemas.OutboxStatus.SENDING,
+            "hash": hash,
+            "batch_index": batch_index,
+            "counter": counter,
+            "expiry_level": expiry_level,
+        }
+    )
+
+
+def requeue_outbox_operations(db: Session, relayer: str, hash: str):
+    """
+    Put back in the queue the operations of the batch `hash`, which was
+    not included.
+    """
+    db.query(models.OutboxOperation).filter(
+        models.OutboxOperation.relayer == relayer
+    ).filter(models.OutboxOperation.hash == hash).filter(
+        models.OutboxOperation.status == schemas.OutboxStatus.SENDING
+    ).update(
+        {
+            "status": schemas.OutboxStatus.PENDING,
+            "hash": None,
+            "batch_index": None,
+            "counter": None,
+            "expiry_level": None,
+        }
+    )
+
+
+FINISHED_OUTBOX_STATUSES = [
+    schemas.OutboxStatus.INJECTED,
+    schemas.OutboxStatus.FAILED,
+    schemas.OutboxStatus.CANCELLED,
+]
+
+
+def purge_outbox_operations(
+    db: Session, relayer: str, before: Optional[datetime.datetime], keep: int
+):
+    """
+    Delete the finished operations of a relayer created before `before`, if
+    given, and all but the last `keep` ones if `keep` is positive.
+    Return the number of deleted operations.
+    """
+    finished = (
+        db.query(models.OutboxOperation)
+        .filter(models.OutboxOperation.relayer == relayer)
+        .filter(models.OutboxOperation.status.in_(FINISHED_OUTBOX_STATUSES))
+    )
+    count = 0
+    if before is not None:
+        count += finished.filter(models.OutboxOperation.created_at < before).delete(
+            synchronize_session=False
+        )
+    if keep > 0:
+        kept = (
+            select(models.OutboxOperation.id)
+            .filter(models.OutboxOperation.relayer == relayer)
+            .filter(models.OutboxOperation.status.in_(FINISHED_OUTBOX_STATUSES))
+            .order_by(models.OutboxOperation.created_at.desc())
+            .limit(keep)
+        )
+        count += finished.filter(models.OutboxOperation.id.not_in(kept)).delete(
+            synchronize_session=False
+        )
+    return count
+
+
+def update_relayer_batch_size(db: Session, relayer: str, size: int):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db.execute(
+        insert(models.RelayerBatch)
+        .values(relayer=relayer, size=size, updated_at=now)
+        .on_conflict_do_update(
+            index_elements=["relayer"], set_={"size": size, "updated_at": now}
+        )
+    )
+
+
+def update_outbox_operation(
+    db: Session,
+    id: UUID4,
+    status: schemas.OutboxStatus,
+    hash: Optional[str] = None,
+    batch_index: Optional[int] = None,
+):
+    values = {"status": status, "hash": hash, "batch_index": batch_index}
+    # Only the result of a finished operation is kept, not the operation
+    if status in FINISHED_OUTBOX_STATUSES:
+        values["contents"] = []
+    db.query(models.OutboxOperation).filter(models.OutboxOperation.id == id).update(
+        values
+    )
+
+
+def create_entrypoint_samples(db: Session, samples: list, window: int):
+    """
+    Record the (contract_address, entrypoint, gas, storage, fee) samples,
+    keeping only the last `window` ones of each entrypoint.
+    """
+    db.add_all(
+        [
+            models.EntrypointSample(
+                contract_address=contract_address,
+                entrypoint=entrypoint,
+                gas=gas,
+                storage=storage,
+                fee=fee,
+            )
+            for contract_address, entrypoint, gas, storage, fee in samples
+        ]
+    )
+    db.flush()
+    for contract_address, entrypoint in {sample[:2] for sample in samples}:
+        kept = (
+            select(models.EntrypointSample.id)
+            .filter(models.EntrypointSample.contract_address == contract_address)
+            .filter(models.EntrypointSample.entrypoint == entrypoint)
+            .order_by(models.EntrypointSample.created_at.desc())
+            .limit(window)
+        )
+        db.query(models.EntrypointSample).filter(
+            models.EntrypointSample.contract_address == contract_address
+        ).filter(models.EntrypointSample.entrypoint == entrypoint).filter(
+            models.EntrypointSample.id.not_in(kept)
+        ).delete(
+            synchronize_session=False
+        )
+
+
+def update_credits_from_contract_address(db: Session, amount: int, address: str):
+    try:
+        db_contract: Optional[models.Credit] = (
+            db.query(models.Contract)
+            .filter(models.Contract.address == address)
+            .one_or_none()
+        )
+        if db_contract is None:
+            raise ContractNotFound()
+        db.query(models.Credit).filter(
+            models.Credit.id == db_contract.credit_id
+        ).update({"amount": db_contract.credit.amount + amount})
+        db.commit()
+        return db_contract.credit
+    except NoResultFound as e:
+        raise CreditNotFound() from e
+
+
+def update_amount_operation(db: Session, hash: str, amount: int):
+    db.query(models.Operation).filter(models.Operation.hash == hash).update(
+        {"cost": amount}
+    )
+    db.commit()
@@ -1,7 +1,14 @@
 from configparser import ConfigParser
-from sqlalchemy import create_engine
+import asyncio
+import os
+import uuid
+
+import psycopg2
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
 
 from .utils import ConfigurationError
 from .config import logging
@@ -22,23 +29,201 @@ def config(filename="sql/database.ini", section="postgresql"):
     return db
 
 
+def setting(params, name, default=None):
+    """Value of `name`, from the environment (DB_<NAME>) or the ini file."""
+    return os.getenv(f"DB_{name.upper()}", params.get(name, default))
+
+
+def is_true(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def engine_options(params, is_async):
+    """Pool and connection options of an engine. Each engine has its own
+    pool; a pool_size of 0 disables pooling."""
+    options = dict(
+        pool_pre_ping=is_true(setting(params, "pool_pre_ping", "true")),
+        pool_recycle=int(setting(params, "pool_recycle", -1)),
+    )
+    pool_size = int(setting(params, "pool_size", 5))
+    if pool_size > 0:
+        options.update(
+            pool_size=pool_size,
+            max_overflow=int(setting(params, "max_overflow", 10)),
+            pool_timeout=float(setting(params, "pool_timeout", 30)),
+        )
+    else:
+        options.update(poolclass=NullPool)
+    # In milliseconds, 0 means no timeout
+    statement_timeout = int(setting(params, "statement_timeout", 0))
+    connect_args = dict()
+    if is_true(setting(params, "pgbouncer", "false")):
+        # Server connections are shared between transactions: no prepared
+        # statements nor startup parameters, which pgbouncer refuses
+        if is_async:
+            connect_args.update(
+                statement_cache_size=0,
+                prepared_statement_cache_size=0,
+                prepared_statement_name_func=lambda: f"__asyncpg_{uuid.uuid4()}__",
+            )
+    elif statement_timeout > 0:
+        if is_async:
+            connect_args["server_settings"] = {
+                "statement_timeout": str(statement_timeout)
+            }
+        else:
+            connect_args["options"] = f"-c statement_timeout={statement_timeout}"
+    options.update(connect_args=connect_args)
+    return options
+
+
+def set_local_statement_timeout(engine, params):
+    """Sets the statement timeout in each transaction, for the connections
+    that do not keep their session settings."""
+    statement_timeout = int(setting(params, "statement_timeout", 0))
+    if statement_timeout <= 0 or not is_true(setting(params, "pgbouncer", "false")):
+        return
+
+    @event.listens_for(engine, "begin")
+    def on_begin(connection):
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {statement_timeout}")
+
+
 try:
     params = config()
-    url = f"postgresql://{params['user']}:{params['password']}@{params['host']}:5432/{params['database']}"
-    engine = create_engine(
-        url=url,
+    credentials = f"{params['user']}:{params['password']}"
+    host = setting(params, "host")
+    port = setting(params, "port", 5432)
+    url = f"postgresql://{credentials}@{host}:{port}/{params['database']}"
+    # LISTEN and session-level advisory locks need a connection of their
+    # own: behind pgbouncer in transaction pooling, they must bypass it.
+    direct_host = setting(params, "direct_host", host)
+    direct_port = setting(params, "direct_port", port)
+    direct_url = (
+        f"postgresql://{credentials}@{direct_host}:{direct_port}/{params['database']}"
     )
+    engine = create_engine(url=url, **engine_options(params, is_async=False))
+    set_local_statement_timeout(engine, params)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    # Used from the event loop; the synchronous sessions are only used from
+    # the RPC thread pool.
+    async_engine = create_async_engine(
+        url=url.replace("postgresql://", "postgresql+asyncpg://", 1),
+        **engine_options(params, is_async=True),
+    )
+    set_local_statement_timeout(async_engine.sync_engine, params)
+    # Objects are still read after the commit, when the session can no
+    # longer load their expired attributes
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False
+    )
+    # Lock connections are held as long as the lock, outside of the pools
+    lock_engine = create_engine(url=direct_url, poolclass=NullPool)
     Base = declarative_base()
 except Exception as e:
     logging.error(f"Error occurred on database configuration : {e}")
     raise ConfigurationError("Cannot connect to database.")
 
 
-def get_db():
-    if SessionLocal:
-        db = SessionLocal()
+def pool_metrics():
+    """Usage of the connection pools."""
+    metrics = dict()
+    for name, pool in (("sync", engine.pool), ("async", async_engine.pool)):
+        if isinstance(pool, QueuePool):
+            metrics[name] = {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            }
+        else:
+            metrics[name] = {"status": pool.status()}
+    return metrics
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def try_advisory_lock(name: str):
+    """
+    Return a connection holding the session-level advisory lock `name`,
+    or None if another connection already holds it.
+    The lock is released when the connection is closed.
+    """
+    connection = lock_engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    locked = connection.execute(
+        text("SELECT pg_try_advisory_lock(hashtext(:name))"), {"name": name}
+    ).scalar()
+    if not locked:
+        connection.close()
+        return None
+    return connection
+
+
+def ping(connection):
+    """Raise an exception if the connection is broken."""
+    connection.execute(text("SELECT 1"))
+
+
+# Dead listening connections are detected by TCP keepalives, and reopened
+# after a delay (in seconds) doubled after each failed attempt
+LISTEN_KEEPALIVES = dict(
+    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+)
+LISTEN_MIN_DELAY = 1
+LISTEN_MAX_DELAY = 60
+
+
+async def listen(channel: str, callback, on_status=None):
+    """
+    Call `callback(payload)` on the running event loop for each
+    notification sent on `channel`, until cancelled. The connection is
+    reopened when it is lost; as notifications may have been missed
+    meanwhile, `on_status(False)` is called when it is lost and
+    `on_status(True)` each time it listens again.
+    """
+    loop = asyncio.get_running_loop()
+    delay = LISTEN_MIN_DELAY
+    while True:
+        try:
+            connection = psycopg2.connect(direct_url, **LISTEN_KEEPALIVES)
+            connection.autocommit = True
+            connection.cursor().execute(f'LISTEN "{channel}"')
+        except psycopg2.Error as e:
+            logging.error(f"Could not listen to {channel} : {e}")
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, LISTEN_MAX_DELAY)
+            continue
+        delay = LISTEN_MIN_DELAY
+        fileno = connection.fileno()
+        lost = loop.create_future()
+
+        def on_readable():
+            try:
+                connection.poll()
+            except psycopg2.Error as e:
+                loop.remove_reader(fileno)
+                if not lost.done():
+                    lost.set_result(e)
+                return
+            while connection.notifies:
+                payload = connection.notifies.pop(0).payload
+                try:
+                    callback(payload)
+                except Exception as e:
+                    logging.error(f"Error occurred on {channel} notification : {e}")
+
+        loop.add_reader(fileno, on_readable)
+        if on_status is not None:
+            on_status(True)
         try:
-            yield db
+            error = await lost
         finally:
-            db.close()
+            loop.remove_reader(fileno)
+            connection.close()
+        logging.error(f"Lost the connection listening to {channel} : {error}")
+        if on_status is not None:
+            on_status(False)
+        await asyncio.sleep(delay)
@@ -3,7 +3,7 @@ import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from . import database as db, routes, models, tezos
+from . import config, database as db, registry, routes, models, tezos
 
 models.Base.metadata.create_all(bind=db.engine)
 
@@ -28,6 +28,12 @@ app.add_middleware(
 loop = asyncio.get_event_loop()
 
 try:
-    asyncio.ensure_future(tezos.tezos_manager.main_loop())
+    asyncio.ensure_future(tezos.nodes.monitor())
+    asyncio.ensure_future(tezos.tezos_manager.listen_results())
+    asyncio.ensure_future(registry.contracts.listen())
+    if config.ENTRYPOINT_PROFILES:
+        asyncio.ensure_future(tezos.entrypoint_profiles.listen())
+    if config.EMBEDDED_BATCHER:
+        asyncio.ensure_future(tezos.tezos_manager.main_loop())
 except KeyboardInterrupt:
     pass
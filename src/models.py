@@ -1,18 +1,22 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     CheckConstraint,
     Column,
+    Date,
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
+    JSON,
     String,
 )
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID
 import uuid
 
-from .schemas import ConditionType
+from .schemas import ConditionType, OutboxStatus
 from .database import Base
 import datetime
 
@@ -30,6 +34,8 @@ class User(Base):
     name = Column(String)
     address = Column(String, unique=True)
     withdraw_counter = Column(Integer, default=0)
+    # Revealed manager public key, cached for the withdraw signature checks
+    public_key = Column(String, nullable=True)
 
     contracts = relationship("Contract", back_populates="owner")
     credits = relationship("Credit", back_populates="owner")
@@ -83,6 +89,8 @@ class Entrypoint(Base):
     operations = relationship("Operation", back_populates="entrypoint")
     conditions = relationship("Condition", back_populates="entrypoint")
 
+    __table_args__ = (Index("ix_entrypoints_contract_id_name", contract_id, name),)
+
 
 # ------- CREDITS ------- #
 
@@ -115,7 +123,7 @@ class Operation(Base):
     user_address = Column(String)
     contract_id = Column(UUID(as_uuid=True), ForeignKey("contracts.id"))
     entrypoint_id = Column(UUID(as_uuid=True), ForeignKey("entrypoints.id"))
-    hash = Column(String)
+    hash = Column(String, index=True)
     status = Column(String)  # TODO Enum
     created_at = Column(DateTime(timezone=True), default=datetime.datetime.utcnow())
 
@@ -123,6 +131,18 @@ class Operation(Base):
     entrypoint = relationship("Entrypoint", back_populates="operations")
 
 
+class MonthlyCalls(Base):
+    """Number of operations recorded for a contract during a month."""
+
+    __tablename__ = "monthly_calls"
+
+    contract_id = Column(
+        UUID(as_uuid=True), ForeignKey("contracts.id"), primary_key=True
+    )
+    month = Column(Date, primary_key=True)  # First day of the month
+    calls = Column(Integer, default=0, nullable=False)
+
+
 # ------- CONDITIONS ------- #
 
 
@@ -167,3 +187,85 @@ class Condition(Base):
     contract = relationship("Contract", back_populates="conditions")
     entrypoint = relationship("Entrypoint", back_populates="conditions")
     vault = relationship("Credit", back_populates="conditions")
+
+    __table_args__ = (
+        Index("ix_conditions_sponsee", type, sponsee_address, vault_id),
+        Index("ix_conditions_entrypoint", contract_id, entrypoint_id, vault_id),
+    )
+
+
+# ------- OUTBOX ------- #
+
+
+class OutboxOperation(Base):
+    __tablename__ = "outbox"
+
+    def __repr__(self):
+        return "OutboxOperation(id='{}', sender='{}', status='{}')".format(
+            self.id, self.sender, self.status
+        )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    sender = Column(String, nullable=False)
+    relayer = Column(String, nullable=False)
+    branch = Column(String)
+    contents = Column(JSON, nullable=False)
+    status = Column(Enum(OutboxStatus), nullable=False)
+    hash = Column(String, index=True)
+    batch_index = Column(Integer)
+    # Counter of the last operation of the batch, and last level at which
+    # the batch can still be included
+    counter = Column(BigInteger)
+    expiry_level = Column(Integer)
+    # Vault paying for the operation, counted by the admission control
+    vault_id = Column(UUID(as_uuid=True))
+    created_at = Column(
+        DateTime(timezone=True), default=datetime.datetime.utcnow, nullable=False
+    )
+
+    __table_args__ = (
+        # Pending operations of a relayer, in queue order
+        Index("ix_outbox_relayer_status_created_at", relayer, status, created_at),
+        # Operations in flight of a vault
+        Index("ix_outbox_vault_id_status", vault_id, status),
+    )
+
+
+class RelayerBatch(Base):
+    """Size of the last batch sent by a relayer, from which the time needed
+    to drain its queue is estimated."""
+
+    __tablename__ = "relayer_batches"
+
+    relayer = Column(String, primary_key=True)
+    size = Column(Integer, nullable=False)
+    updated_at = Column(
+        DateTime(timezone=True), default=datetime.datetime.utcnow, nullable=False
+    )
+
+
+class EntrypointSample(Base):
+    """Gas, storage and fee of a call to an entrypoint, from the receipt of
+    its batch."""
+
+    __tablename__ = "entrypoint_samples"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    contract_address = Column(String, nullable=False)
+    entrypoint = Column(String, nullable=False)
+    gas = Column(Integer, nullable=False)
+    storage = Column(Integer, nullable=False)
+    fee = Column(Integer, nullable=False)
+    created_at = Column(
+        DateTime(timezone=True), default=datetime.datetime.utcnow, nullable=False
+    )
+
+    # Last samples of an entrypoint
+    __table_args__ = (
+        Index(
+            "ix_entrypoint_samples_contract_address_entrypoint_created_at",
+            contract_address,
+            entrypoint,
+            created_at,
+        ),
+    )
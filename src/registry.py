@@ -0,0 +1,68 @@
+"""Contracts and entrypoints of the sponsored calls, kept in memory."""
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, database, schemas
+
+
+class ContractRegistry:
+    """Contracts by address, with their entrypoints by name. An entry is
+    dropped when crud notifies a change of the contract, from any process:
+    contracts are only kept while the registry is connected to receive these
+    notifications, and all of them are dropped when the connection is
+    lost."""
+
+    def __init__(self):
+        self.contracts: dict[str, schemas.RegisteredContract] = {}
+        # Incremented on each invalidation, so that a contract read from the
+        # database meanwhile is not kept.
+        self.generation = 0
+        self.listening = False
+
+    def invalidate(self, address: str = ""):
+        """Drops the contract `address`, or all of them when empty."""
+        self.generation += 1
+        if address == "":
+            self.contracts.clear()
+        else:
+            self.contracts.pop(address, None)
+
+    async def get_contract(self, db: AsyncSession, address: str):
+        """
+        Return a schemas.RegisteredContract or raise ContractNotFound exception
+        """
+        contract = self.contracts.get(address)
+        if contract is not None:
+            return contract
+        generation = self.generation
+        db_contract = await crud.get_contract_by_address(db, address)
+        contract = schemas.RegisteredContract(
+            id=db_contract.id,
+            address=db_contract.address,
+            credit_id=db_contract.credit_id,
+            max_calls_per_month=db_contract.max_calls_per_month,
+            entrypoints={
+                e.name: schemas.Entrypoint(
+                    id=e.id,
+                    name=e.name,
+                    contract_id=e.contract_id,
+                    is_enabled=e.is_enabled,
+                )
+                for e in db_contract.entrypoints
+            },
+        )
+        if self.listening and generation == self.generation:
+            self.contracts[address] = contract
+        return contract
+
+    def on_listening(self, listening):
+        """Contracts are only kept while the connection receiving their
+        changes is up: those changed while it is lost would stay stale."""
+        self.listening = listening
+        self.invalidate()
+
+    async def listen(self):
+        """Receives the changes made by every process, this one included."""
+        await database.listen(crud.REGISTRY_CHANNEL, self.invalidate, self.on_listening)
+
+
+contracts = ContractRegistry()
@@ -1,8 +1,8 @@
 from fastapi import APIRouter, HTTPException, status, Depends
 import asyncio
 
-from sqlalchemy.orm import Session
-from . import tezos, crud, schemas, database
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import tezos, crud, schemas, database, registry
 from pytezos.rpc.errors import MichelsonError
 from pytezos.crypto.encoding import is_address
 from .utils import (
@@ -16,7 +16,11 @@ from .utils import (
     TooManyCallsForThisMonth,
     NotEnoughFunds,
     UserNotFound,
+    OperationFailed,
     OperationNotFound,
+    OperationTimeout,
+    QueueFull,
+    TooManyOperationsInFlight,
 )
 from .config import logging
 from .schemas import ConditionType
@@ -33,22 +37,27 @@ async def root():
     return {"message": "Hello World"}
 
 
+@router.get("/metrics/pool")
+async def pool_metrics():
+    return database.pool_metrics()
+
+
 # POST endpoints
 @router.post("/users", response_model=schemas.User)
 async def create_user(
-    user: schemas.UserCreation, db: Session = Depends(database.get_db)
+    user: schemas.UserCreation, db: AsyncSession = Depends(database.get_db)
 ):
-    user = crud.create_user(db, user)
-    crud.create_credits(db, schemas.CreditCreation(owner_id=user.id))
+    user = await crud.create_user(db, user)
+    await crud.create_credits(db, schemas.CreditCreation(owner_id=user.id))
     return user
 
 
 @router.post("/contracts", response_model=schemas.Contract)
 async def create_contract(
-    contract: schemas.ContractCreation, db: Session = Depends(database.get_db)
+    contract: schemas.ContractCreation, db: AsyncSession = Depends(database.get_db)
 ):
     try:
-        return crud.create_contract(db, contract)
+        return await crud.create_contract(db, contract)
     except ContractAlreadyRegistered:
         logging.warn(f"Contract {contract.address} is already registered")
         raise HTTPException(
@@ -60,17 +69,18 @@ async def create_contract(
 # PUT endpoints
 @router.put("/entrypoints", response_model=list[schemas.Entrypoint])
 async def update_entrypoints(
-    entrypoints: list[schemas.EntrypointUpdate], db: Session = Depends(database.get_db)
+    entrypoints: list[schemas.EntrypointUpdate],
+    db: AsyncSession = Depends(database.get_db),
 ):
-    return crud.update_entrypoints(db, entrypoints)
+    return await crud.update_entrypoints(db, entrypoints)
 
 
 @router.put("/deposit", response_model=schemas.Credit)
 async def update_credits(
-    credits: schemas.CreditUpdate, db: Session = Depends(database.get_db)
+    credits: schemas.CreditUpdate, db: AsyncSession = Depends(database.get_db)
 ):
     try:
-        payer_address = crud.get_credits(db, credits.id).owner.address
+        payer_address = (await crud.get_credits(db, credits.id)).owner.address
         op_hash = credits.operation_hash
         amount = credits.amount
         is_confirmed = await tezos.confirm_deposit(op_hash, payer_address, amount)
@@ -80,7 +90,7 @@ async def update_credits(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f"Could not find confirmation for {amount} with {op_hash}",
             )
-        return crud.update_credits(db, credits)
+        return await crud.update_credits(db, credits)
     except ContractNotFound:
         logging.warning(f"Contrat not found.")
         raise HTTPException(
@@ -103,10 +113,10 @@ async def update_credits(
 
 @router.put("/withdraw")
 async def withdraw_credits(
-    withdraw: schemas.CreditWithdraw, db: Session = Depends(database.get_db)
+    withdraw: schemas.CreditWithdraw, db: AsyncSession = Depends(database.get_db)
 ):
     try:
-        credits = crud.get_credits(db, withdraw.id)
+        credits = await crud.get_credits(db, withdraw.id)
     except CreditNotFound:
         logging.warning(f"Credit not found.")
         raise HTTPException(
@@ -128,9 +138,20 @@ async def withdraw_credits(
         )
 
     owner_address = credits.owner.address
-    user = crud.get_user_by_address(db, owner_address)
-    public_key = tezos.get_public_key(owner_address)
-    is_valid = tezos.check_signature(
+    user = await crud.get_user_by_address(db, owner_address)
+    # The revealed key is stored with the user, so that the node is only
+    # asked once per user.
+    public_key = user.public_key
+    if public_key is None:
+        public_key = await tezos.get_public_key(owner_address)
+        if public_key is None:
+            logging.warning(f"Account {owner_address} is not revealed.")
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Account is not revealed.",
+            )
+        await crud.update_user_public_key(db, str(user.id), public_key)
+    is_valid = await tezos.check_signature(
         withdraw.to_micheline_pair(), withdraw.micheline_signature, public_key
     )
     if not is_valid:
@@ -140,7 +161,7 @@ async def withdraw_credits(
         )
     # We increment the counter even if the withdraw fails to prevent
     # the counter from being used again immediately.
-    counter = crud.update_user_withdraw_counter(
+    counter = await crud.update_user_withdraw_counter(
         db, str(user.id), withdraw.withdraw_counter + 1
     )
     result = await tezos.withdraw(tezos.tezos_manager, owner_address, withdraw.amount)
@@ -149,9 +170,7 @@ async def withdraw_credits(
         # Starts a independent loop to check that the operation
         # has been confirmed
         asyncio.create_task(
-            tezos.confirm_withdraw(
-                result["transaction_hash"], db, str(user.id), withdraw
-            )
+            tezos.confirm_withdraw(result["transaction_hash"], str(user.id), withdraw)
         )
 
     return {**result, "counter": counter}
@@ -159,12 +178,12 @@ async def withdraw_credits(
 
 # Users and credits getters
 @router.get("/users/{address_or_id}", response_model=schemas.User)
-async def get_user(address_or_id: str, db: Session = Depends(database.get_db)):
+async def get_user(address_or_id: str, db: AsyncSession = Depends(database.get_db)):
     try:
         if is_address(address_or_id) and address_or_id.startswith("tz"):
-            return crud.get_user_by_address(db, address_or_id)
+            return await crud.get_user_by_address(db, address_or_id)
         else:
-            return crud.get_user(db, address_or_id)
+            return await crud.get_user(db, address_or_id)
     except UserNotFound:
         logging.warning(f"User {address_or_id} not found")
         raise HTTPException(
@@ -175,13 +194,13 @@ async def get_user(address_or_id: str, db: Session = Depends(database.get_db)):
 
 @router.get("/credits/{user_address_or_id}", response_model=list[schemas.Credit])
 async def credits_for_user(
-    user_address_or_id: str, db: Session = Depends(database.get_db)
+    user_address_or_id: str, db: AsyncSession = Depends(database.get_db)
 ):
     try:
         if is_address(user_address_or_id) and user_address_or_id.startswith("tz"):
-            return crud.get_user_by_address(db, user_address_or_id).credits
+            return (await crud.get_user_by_address(db, user_address_or_id)).credits
         else:
-            return crud.get_user(db, user_address_or_id).credits
+            return (await crud.get_user(db, user_address_or_id)).credits
     except UserNotFound:
         logging.warning(f"User {user_address_or_id} not found")
         raise HTTPException(
@@ -192,9 +211,11 @@ async def credits_for_user(
 
 # Contracts
 @router.get("/contracts/user/{user_address}", response_model=list[schemas.Contract])
-async def get_user_contracts(user_address: str, db: Session = Depends(database.get_db)):
+async def get_user_contracts(
+    user_address: str, db: AsyncSession = Depends(database.get_db)
+):
     try:
-        return crud.get_contracts_by_user(db, user_address)
+        return await crud.get_contracts_by_user(db, user_address)
     except UserNotFound:
         logging.warning(f"User {user_address} not found.")
         raise HTTPException(
@@ -203,9 +224,9 @@ async def get_user_contracts(user_address: str, db: Session = Depends(database.g
 
 
 @router.get("/contracts/credit/{credit_id}", response_model=list[schemas.Contract])
-async def get_credit(credit_id: str, db: Session = Depends(database.get_db)):
+async def get_credit(credit_id: str, db: AsyncSession = Depends(database.get_db)):
     try:
-        return crud.get_contracts_by_credit(db, credit_id)
+        return await crud.get_contracts_by_credit(db, credit_id)
     except CreditNotFound:
         logging.warning(f"Credit {credit_id} not found.")
         raise HTTPException(
@@ -214,11 +235,11 @@ async def get_credit(credit_id: str, db: Session = Depends(database.get_db)):
 
 
 @router.get("/contracts/{address_or_id}", response_model=schemas.Contract)
-async def get_contract(address_or_id: str, db: Session = Depends(database.get_db)):
+async def get_contract(address_or_id: str, db: AsyncSession = Depends(database.get_db)):
     if is_address(address_or_id) and address_or_id.startswith("KT"):
-        contract = crud.get_contract_by_address(db, address_or_id)
+        contract = await crud.get_contract_by_address(db, address_or_id)
     else:
-        contract = crud.get_contract(db, address_or_id)
+        contract = await crud.get_contract(db, address_or_id)
     if not contract:
         logging.warning(f"Contract {address_or_id} not found.")
         raise HTTPException(
@@ -232,12 +253,12 @@ async def get_contract(address_or_id: str, db: Session = Depends(database.get_db
     "/entrypoints/{contract_address_or_id}", response_model=list[schemas.Entrypoint]
 )
 async def get_entrypoints(
-    contract_address_or_id: str, db: Session = Depends(database.get_db)
+    contract_address_or_id: str, db: AsyncSession = Depends(database.get_db)
 ):
     try:
         if contract_address_or_id.startswith("KT"):
             assert is_address(contract_address_or_id)
-        return crud.get_entrypoints(db, contract_address_or_id)
+        return await crud.get_entrypoints(db, contract_address_or_id)
     except ContractNotFound:
         logging.warning(f"Contract {contract_address_or_id} not found.")
         raise HTTPException(
@@ -254,10 +275,10 @@ async def get_entrypoints(
     "/entrypoints/{contract_address_or_id}/{name}", response_model=schemas.Entrypoint
 )
 async def get_entrypoint(
-    contract_address_or_id: str, name: str, db: Session = Depends(database.get_db)
+    contract_address_or_id: str, name: str, db: AsyncSession = Depends(database.get_db)
 ):
     try:
-        return crud.get_entrypoint(db, contract_address_or_id, name)
+        return await crud.get_entrypoint(db, contract_address_or_id, name)
     except EntrypointNotFound:
         logging.warning(f"Entrypoint {contract_address_or_id} not found.")
         raise HTTPException(
@@ -268,7 +289,7 @@ async def get_entrypoint(
 # Operations
 @router.post("/operation")
 async def post_operation(
-    call_data: schemas.UnsignedCall, db: Session = Depends(database.get_db)
+    call_data: schemas.UnsignedCall, db: AsyncSession = Depends(database.get_db)
 ):
     if len(call_data.operations) == 0:
         logging.warning(f"Operations list is empty")
@@ -288,7 +309,7 @@ async def post_operation(
                 detail=f"Target {contract_address} is not allowed",
             )
         try:
-            contract = crud.get_contract_by_address(db, contract_address)
+            contract = await registry.contracts.get_contract(db, contract_address)
         except ContractNotFound:
             logging.warning(f"{contract_address} is not found")
             raise HTTPException(
@@ -299,11 +320,13 @@ async def post_operation(
         entrypoint_name = operation["parameters"]["entrypoint"]
 
         try:
-            entrypoint = crud.get_entrypoint(db, str(contract.address), entrypoint_name)
+            entrypoint = contract.entrypoints.get(entrypoint_name)
+            if entrypoint is None:
+                raise EntrypointNotFound()
             if not entrypoint.is_enabled:
                 raise EntrypointDisabled()
 
-            if not crud.check_conditions(
+            if not await crud.check_conditions(
                 db,
                 schemas.CheckConditions(
                     sponsee_address=call_data.sender_address,
@@ -333,9 +356,15 @@ async def post_operation(
             )
 
     try:
-        # Simulate the operation alone without sending it
-        # TODO: log the result
-        op = tezos.simulate_transaction(call_data.operations)
+        # Shed load early when the relayer queues are already full
+        await tezos.tezos_manager.admission(contract.credit_id)
+        # Well-known entrypoints are estimated from the receipts of their
+        # previous calls; the batch is simulated anyway before injection.
+        op = tezos.estimate_transaction(call_data.operations)
+        if op is None:
+            # Simulate the operation alone without sending it
+            # TODO: log the result
+            op = await tezos.simulate_transaction(call_data.operations)
 
         logging.debug(f"Result of operation simulation : {op}")
 
@@ -344,18 +373,22 @@ async def post_operation(
 
         logging.debug(f"Estimated fees: {estimated_fees}")
 
-        if not tezos.check_credits(db, estimated_fees):
+        if not await tezos.check_credits(db, estimated_fees):
             logging.warning(f"Not enough funds to pay estimated fees.")
             raise NotEnoughFunds(
                 f"Estimated fees : {estimated_fees[str(contract.address)]} mutez"
             )
-        if not crud.check_calls_per_month(db, contract.id):  # type: ignore
+        if not await crud.check_calls_per_month(
+            db, contract.id, contract.max_calls_per_month
+        ):
             logging.warning(f"Too many calls made for this contract this month.")
             raise TooManyCallsForThisMonth()
 
-        result = await tezos.tezos_manager.queue_operation(call_data.sender_address, op)
+        result = await tezos.tezos_manager.queue_operation(
+            call_data.sender_address, op, contract.credit_id
+        )
 
-        crud.create_operation(
+        await crud.create_operation(
             db,
             schemas.CreateOperation(
                 user_address=call_data.sender_address, contract_id=str(contract.id), entrypoint_id=str(entrypoint.id), hash=result["transaction_hash"], status=result["result"]  # type: ignore
@@ -369,6 +402,12 @@ async def post_operation(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Operation is invalid",
         )
+    except OperationFailed as e:
+        logging.error(f"Operation failed {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Operation failed",
+        )
     except NotEnoughFunds as e:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail=f"Not enough funds. {e}"
@@ -378,6 +417,27 @@ async def post_operation(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"Too many calls made for this contract this month.",
         )
+    except QueueFull as e:
+        logging.warning(f"Relayer queue is full.")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Too many operations are waiting, please retry later.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except TooManyOperationsInFlight as e:
+        logging.warning(
+            f"Too many operations in flight for vault {contract.credit_id}."
+        )
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many operations in flight for this vault, please retry later.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except OperationTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"Operation could not be injected in time.",
+        )
     except Exception as e:
         logging.error(f"Unknown error on /operation : {e}")
         raise HTTPException(
@@ -390,12 +450,12 @@ async def post_operation(
 
 @router.post("/signed_operation")
 async def signed_operation(
-    call_data: schemas.SignedCall, db: Session = Depends(database.get_db)
+    call_data: schemas.SignedCall, db: AsyncSession = Depends(database.get_db)
 ):
     # In order for the user to sign Micheline, we need to
     # FIXME: this is a serious issue, we should sign the contract address too.
     signed_data = [x["parameters"]["value"] for x in call_data.operations]
-    if not tezos.check_signature(
+    if not await tezos.check_signature(
         signed_data, call_data.signature, call_data.sender_key, call_data.micheline_type
     ):
         logging.warning("Invalid signature.")
@@ -415,18 +475,20 @@ async def signed_operation(
 async def update_max_calls(
     contract_id: str,
     body: schemas.UpdateMaxCallsPerMonth,
-    db: Session = Depends(database.get_db),
+    db: AsyncSession = Depends(database.get_db),
 ):
     if body.max_calls < -1:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Max calls cannot be < -1"
         )
-    return crud.update_max_calls_per_month_condition(db, body.max_calls, contract_id)
+    return await crud.update_max_calls_per_month_condition(
+        db, body.max_calls, contract_id
+    )
 
 
 @router.post("/condition")
 async def create_condition(
-    body: schemas.CreateCondition, db: Session = Depends(database.get_db)
+    body: schemas.CreateCondition, db: AsyncSession = Depends(database.get_db)
 ):
     try:
         if (
@@ -434,7 +496,7 @@ async def create_condition(
             and body.contract_id is not None
             and body.entrypoint_id is not None
         ):
-            return crud.create_max_calls_per_entrypoint_condition(
+            return await crud.create_max_calls_per_entrypoint_condition(
                 db,
                 schemas.CreateMaxCallsPerEntrypointCondition(
                     contract_id=body.contract_id,
@@ -447,7 +509,7 @@ async def create_condition(
             body.type == ConditionType.MAX_CALLS_PER_SPONSEE
             and body.sponsee_address is not None
         ):
-            return crud.create_max_calls_per_sponsee_condition(
+            return await crud.create_max_calls_per_sponsee_condition(
                 db,
                 schemas.CreateMaxCallsPerSponseeCondition(
                     sponsee_address=body.sponsee_address,
@@ -471,6 +533,6 @@ async def create_condition(
 
 @router.get("/condition/{vault_id}")
 async def get_conditions_by_vault(
-    vault_id: str, db: Session = Depends(database.get_db)
+    vault_id: str, db: AsyncSession = Depends(database.get_db)
 ):
-    return crud.get_conditions_by_vault(db, vault_id)
+    return await crud.get_conditions_by_vault(db, vault_id)
@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import time
+
+from pytezos.rpc import RpcNode, ShellQuery
+from pytezos.rpc.node import (
+    TRANSIENT_RETRY_ATTEMPTS,
+    TRANSIENT_RETRY_INITIAL_DELAY,
+    TRANSIENT_RETRY_MAX_DELAY,
+    RpcError,
+    RpcForbiddenError,
+    RpcNotFoundError,
+    _is_transient_response,
+)
+from requests.adapters import HTTPAdapter
+import requests
+
+from . import config
+
+log = config.logging
+
+# pytezos is synchronous: its calls are run in this pool so that a slow
+# RPC request does not block the event loop.
+executor = ThreadPoolExecutor(
+    max_workers=config.RPC_THREADS, thread_name_prefix="tezos-rpc"
+)
+# Attempts on the same node when there is no other one to fail over to, and
+# delay (in seconds) before the first retry, doubled after each one
+RETRIES = 3
+RETRY_DELAY = 1
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking call in the RPC thread pool and returns its result."""
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+class PooledRpcNode(RpcNode):
+    """RpcNode reusing keep-alive connections instead of opening a new one
+    for each request."""
+
+    def __init__(self, uri, headers=None):
+        super().__init__(uri, headers)
+        # Health of the node, as seen by the NodePool
+        self.latency = None
+        self.level = None
+        self.header = None
+        self.lagging = False
+        self.ejected_until = 0.0
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.RPC_THREADS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        timeout = kwargs.pop("timeout", None) or 60
+        delay = TRANSIENT_RETRY_INITIAL_DELAY
+        for attempt in range(TRANSIENT_RETRY_ATTEMPTS):
+            res = self.session.request(
+                method=method,
+                url="/".join(x.strip("/") for x in (self.uri[0], path)),
+                headers={
+                    "content-type": "application/json",
+                    "user-agent": "PyTezos",
+                    **self.headers,
+                },
+                timeout=timeout,
+                **kwargs,
+            )
+            # As RpcNode does, the 500 errors octez marks as temporary (e.g.
+            # the mempool while a block is baked) are retried with a backoff
+            if (
+                res.status_code >= 500
+                and _is_transient_response(res)
+                and attempt < TRANSIENT_RETRY_ATTEMPTS - 1
+            ):
+                log.debug(f"Transient {res.status_code} on {method} {path}")
+                time.sleep(delay)
+                delay = min(delay * 2, TRANSIENT_RETRY_MAX_DELAY)
+                continue
+            break
+        # Raised as requests.HTTPError, the node being unavailable
+        if res.status_code in (502, 503, 504):
+            res.raise_for_status()
+        if res.status_code in (401, 403):
+            raise RpcForbiddenError(f"Forbidden: {path}")
+        if res.status_code == 404:
+            raise RpcNotFoundError(f"Not found: {path}")
+        if res.status_code != 200:
+            raise RpcError.from_response(res)
+        return res
+
+
+class NodePool(RpcNode):
+    """Spreads the requests between several nodes. Reads and simulations go
+    to the fastest healthy node, injections to the preferred ones; a node is
+    ejected for RPC_EJECTION_TIME seconds when it fails, and while it lags
+    more than RPC_MAX_LAG blocks behind the others."""
+
+    def __init__(self, uris, injection_uris=()):
+        super().__init__(list(uris))
+        self.nodes = [PooledRpcNode(uri) for uri in self.uri]
+        self.injection_nodes = [
+            node for node in self.nodes if node.uri[0] in injection_uris
+        ] or self.nodes
+
+    def candidates(self, nodes):
+        """Healthy nodes first, fastest first; the others are still tried
+        as a last resort."""
+        now = time.monotonic()
+
+        def rank(node):
+            healthy = node.ejected_until <= now and not node.lagging
+            latency = float("inf") if node.latency is None else node.latency
+            return (not healthy, latency)
+
+        return sorted(nodes, key=rank)
+
+    def eject(self, node, error):
+        log.warning(f"Node {node.uri[0]} is unavailable : {error}")
+        node.ejected_until = time.monotonic() + config.RPC_EJECTION_TIME
+
+    def request(self, method, path, **kwargs):
+        is_injection = path.strip("/").startswith("injection")
+        nodes = self.injection_nodes if is_injection else self.nodes
+        candidates = self.candidates(nodes)
+        # A single node is retried, as transient errors would otherwise
+        # fail the request at once
+        if len(candidates) == 1:
+            candidates = candidates * RETRIES
+        for attempt, node in enumerate(candidates):
+            if attempt > 0 and node is candidates[attempt - 1]:
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                return node.request(method, path, **kwargs)
+            except requests.RequestException as e:
+                # The node itself is unreachable; errors about the request
+                # are raised as they would be by any other node.
+                self.eject(node, e)
+                error = e
+        raise error
+
+    def probe(self, node):
+        start = time.monotonic()
+        try:
+            header = node.get("/chains/main/blocks/head/header")
+        except (requests.RequestException, RpcError) as e:
+            self.eject(node, e)
+            return
+        latency = time.monotonic() - start
+        # Smoothed, so that one slow answer does not reorder the nodes
+        node.latency = (
+            latency if node.latency is None else 0.8 * node.latency + 0.2 * latency
+        )
+        node.level = int(header["level"])
+        node.header = header
+
+    def head(self):
+        """Last header of the most advanced node, when known."""
+        top = max(
+            (node for node in self.nodes if node.level is not None),
+            key=lambda node: node.level,
+            default=None,
+        )
+        return None if top is None else top.header
+
+    async def monitor(self):
+        """Measures the latency and head level of each node."""
+        while True:
+            try:
+                await asyncio.gather(*[run(self.probe, node) for node in self.nodes])
+                top = max(
+                    (node.level for node in self.nodes if node.level is not None),
+                    default=None,
+                )
+                for node in self.nodes:
+                    lagging = (
+                        node.level is not None and top - node.level > config.RPC_MAX_LAG
+                    )
+                    if lagging and not node.lagging:
+                        log.warning(f"Node {node.uri[0]} lags at level {node.level}")
+                    node.lagging = lagging
+            except Exception as e:
+                log.error(f"Error occurred while monitoring nodes : {e}")
+            await asyncio.sleep(config.HEAD_POLLING_INTERVAL)
+
+
+def shell(node):
+    return ShellQuery(node)
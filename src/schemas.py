@@ -10,6 +10,15 @@ class ConditionType(enum.Enum):
     MAX_CALLS_PER_SPONSEE = "MAX_CALLS_PER_SPONSEE"
 
 
+class OutboxStatus(enum.Enum):
+    PENDING = "PENDING"
+    # Signed and about to be injected, the injection not being confirmed yet
+    SENDING = "SENDING"
+    INJECTED = "INJECTED"
+    FAILED = "FAILED"
+    CANCELLED = "CANCELLED"
+
+
 # Users
 class UserBase(BaseModel):
     address: str
@@ -107,6 +116,17 @@ class ContractCreation(ContractBase):
     credit_id: UUID4
 
 
+class RegisteredContract(BaseModel):
+    """Contract as kept by the registry: its credits, which change with
+    every call, are left out."""
+
+    id: UUID4
+    address: str
+    credit_id: UUID4
+    max_calls_per_month: int
+    entrypoints: dict[str, Entrypoint]
+
+
 # Operations
 class UnsignedCall(BaseModel):
     """Data sent when posting an operation. The sender is mandatory."""
@@ -132,6 +152,17 @@ class CreateOperation(BaseModel):
     status: str
 
 
+class CreateOutboxOperation(BaseModel):
+    """Operation waiting in the outbox to be sent by `relayer`."""
+
+    id: UUID4
+    sender: str
+    relayer: str
+    branch: Optional[str] = None
+    contents: list[dict[str, Any]]
+    vault_id: Optional[UUID4] = None
+
+
 # Conditions
 class UpdateMaxCallsPerMonth(BaseModel):
     max_calls: int
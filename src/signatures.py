@@ -0,0 +1,52 @@
+"""Signature checks, run in worker processes by `tezos.check_signature`.
+
+This module is imported by the workers: it must stay free of the
+configuration and of any client or database connection.
+"""
+import functools
+import json
+
+from pytezos.michelson.types.base import MichelsonType
+import pytezos
+
+
+# Type of a withdraw operation
+WITHDRAW_TYPE = {
+    "prim": "pair",
+    "args": [{"prim": "string"}, {"prim": "int"}, {"prim": "mutez"}],
+}
+
+
+@functools.lru_cache(maxsize=256)
+def matcher(type_json):
+    """Compiled type of a canonical JSON Michelson type. Callers supply
+    their own types, hence the bounded cache."""
+    return MichelsonType.match(json.loads(type_json))
+
+
+def verify(pair_data, signature, public_key, pair_type=None):
+    if pair_type is None:
+        pair_type = WITHDRAW_TYPE
+    public_key = pytezos.Key.from_encoded_key(public_key)
+    packed_pair = (
+        matcher(json.dumps(pair_type, sort_keys=True))
+        .from_micheline_value(pair_data)
+        .pack()
+    )
+    try:
+        # .verify raises an exception when the verification fails
+        return public_key.verify(message=packed_pair, signature=signature)
+    except ValueError:
+        return False
+
+
+def verify_batch(checks):
+    """Verifies a list of (pair_data, signature, public_key, pair_type);
+    returns, for each of them, its result or the exception it raised."""
+    results = []
+    for check in checks:
+        try:
+            results.append(verify(*check))
+        except Exception as e:
+            results.append(e)
+    return results
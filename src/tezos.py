@@ -1,11 +1,36 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import asyncio
+import copy
+import datetime
+import json
+import math
+import multiprocessing
+import time
+import uuid
 from typing import Union
 
-from . import crud, schemas, config, database
-from .utils import OperationNotFound
-from pytezos.rpc.errors import MichelsonError
-from pytezos.michelson.types.base import MichelsonType
+from . import crud, schemas, config, database, rpc, signatures
+from .batching import (
+    CounterManager,
+    SimulationCache,
+    is_conflict_error,
+    is_counter_error,
+    pack_operations,
+    validate_operations,
+)
+from .utils import (
+    OperationFailed,
+    OperationNotFound,
+    OperationTimeout,
+    QueueFull,
+    TooManyOperationsInFlight,
+)
+from pytezos.operation import DEFAULT_BURN_RESERVE, DEFAULT_GAS_RESERVE
+from pytezos.operation.fees import calculate_fee
+from pytezos.operation.result import OperationResult
+from pytezos.rpc.errors import RpcError
 import pytezos
 
 
@@ -17,28 +42,153 @@ assert (
 ), "Could not read secret key"
 
 admin_key = pytezos.pytezos.key.from_encoded_key(config.SECRET_KEY)
-ptz = pytezos.pytezos.using(config.TEZOS_RPC, admin_key)
+nodes = rpc.NodePool(config.TEZOS_RPC, config.TEZOS_INJECTION_RPC)
+ptz = pytezos.pytezos.using(rpc.shell(nodes), admin_key)
 log.info(f"API address is {ptz.key.public_key_hash()}")
+# The admin account holds the deposits; other relayers only pay batch fees.
+relayers = [ptz] + [
+    pytezos.pytezos.using(rpc.shell(nodes), pytezos.Key.from_encoded_key(key))
+    for key in config.RELAYER_SECRET_KEYS
+]
+for relayer in relayers[1:]:
+    log.info(f"Relayer address is {relayer.key.public_key_hash()}")
 constants = ptz.shell.block.context.constants()
 
 
+class InclusionTracker:
+    """Follows the chain head and indexes the operation hashes of the last
+    `depth` blocks. Each block is read once, whatever the number of
+    operations waiting for a confirmation, and only the receipts of the
+    operations found are downloaded."""
+
+    def __init__(self, client, depth, timeout, cache_size):
+        self.client = client
+        self.depth = depth
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.levels = dict()  # level -> block hash
+        # LRU cache: block hash -> {operation hash: (validation pass, position)}
+        self.indexes = OrderedDict()
+        self.waiters = dict()  # operation hash -> futures
+        self.task = None
+
+    async def block_index(self, block_hash):
+        if block_hash in self.indexes:
+            self.indexes.move_to_end(block_hash)
+            return self.indexes[block_hash]
+        operation_hashes = await rpc.run(
+            self.client.shell.blocks[block_hash].operation_hashes
+        )
+        index = {
+            tx_hash: (validation_pass, position)
+            for validation_pass, hashes in enumerate(operation_hashes)
+            for position, tx_hash in enumerate(hashes)
+        }
+        self.indexes[block_hash] = index
+        while len(self.indexes) > self.cache_size:
+            self.indexes.popitem(last=False)
+        return index
+
+    async def fetch_operation(self, block_hash, tx_hash):
+        validation_pass, position = (await self.block_index(block_hash))[tx_hash]
+        operations = self.client.shell.blocks[block_hash].operations
+        return await rpc.run(operations[validation_pass][position])
+
+    async def search(self, tx_hash):
+        for _, block_hash in sorted(self.levels.items(), reverse=True):
+            if tx_hash in await self.block_index(block_hash):
+                return await self.fetch_operation(block_hash, tx_hash)
+        return None
+
+    async def index_block(self, header):
+        block_hash = header["hash"]
+        self.levels[int(header["level"])] = block_hash
+        while len(self.levels) > self.depth:
+            del self.levels[min(self.levels)]
+        index = await self.block_index(block_hash)
+        for tx_hash in index.keys() & self.waiters.keys():
+            operation = await self.fetch_operation(block_hash, tx_hash)
+            for waiter in self.waiters.pop(tx_hash):
+                if not waiter.done():
+                    waiter.set_result(operation)
+
+    async def index_chain(self, header):
+        """Indexes the blocks from the head `header` back to the first one
+        already indexed, so that the blocks replaced by a reorganization are
+        indexed again."""
+        head_level = int(header["level"])
+        # Levels above the head belong to a branch which is no longer the
+        # main one
+        for level in [level for level in self.levels if level > head_level]:
+            del self.levels[level]
+        headers = []
+        while len(headers) < self.depth:
+            if self.levels.get(int(header["level"])) == header["hash"]:
+                break
+            headers.append(header)
+            header = await rpc.run(
+                self.client.shell.blocks[header["predecessor"]].header
+            )
+        for header in reversed(headers):
+            await self.index_block(header)
+
+    async def run(self):
+        while True:
+            try:
+                await self.index_chain(await rpc.run(self.client.shell.head.header))
+            except Exception as e:
+                log.error(f"Error occurred on inclusion tracker : {e}")
+            await asyncio.sleep(config.HEAD_POLLING_INTERVAL)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def is_included(self, tx_hash):
+        """Whether the operation `tx_hash` is in one of the indexed blocks."""
+        self.start()
+        for _, block_hash in sorted(self.levels.items(), reverse=True):
+            if tx_hash in await self.block_index(block_hash):
+                return True
+        return False
+
+    async def find(self, tx_hash):
+        """Returns the operation `tx_hash` once it is included, or raises
+        OperationNotFound if it is not after `timeout` seconds."""
+        self.start()
+        # Registered before searching, so that a block indexed meanwhile
+        # wakes it up
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(tx_hash, []).append(waiter)
+        try:
+            operation = await self.search(tx_hash)
+            if operation is not None:
+                return operation
+            return await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError as e:
+            raise OperationNotFound(tx_hash) from e
+        finally:
+            waiters = self.waiters.get(tx_hash, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+                if len(waiters) == 0:
+                    del self.waiters[tx_hash]
+
+
+# Operations are searched in the last 10 blocks, and awaited for 4 more
+inclusion_tracker = InclusionTracker(
+    ptz,
+    depth=10,
+    timeout=4 * int(constants["minimal_block_delay"]),
+    cache_size=config.BLOCK_INDEX_CACHE_SIZE,
+)
+
+
 async def find_transaction(tx_hash):
     """Finds the transaction from its hash.
     This function searches the last 10 blocks
     """
-    block_time = int(constants["minimal_block_delay"])
-    nb_try = 0
-    while nb_try < 4:
-        try:
-            op_result = ptz.shell.blocks[-10:].find_operation(tx_hash)
-            break
-        except Exception:
-            nb_try += 1
-            await asyncio.sleep(block_time)
-    else:
-        raise OperationNotFound(tx_hash)
-
-    return op_result
+    return await inclusion_tracker.find(tx_hash)
 
 
 def find_fees(global_tx, payer_key):
@@ -68,9 +218,9 @@ def group_fees(fees: list[tuple[int, str]]):
     return grouped_fees
 
 
-def check_credits(db, estimated_fees):
+async def check_credits(db, estimated_fees):
     for address, total_fee in estimated_fees.items():
-        credits = crud.get_credits_from_contract_address(db, address)
+        credits = await crud.get_credits_from_contract_address(db, address)
         if total_fee > credits.amount:
             log.warning(
                 f"Unsufficient credits {credits.amount} for contract"
@@ -93,7 +243,7 @@ async def confirm_deposit(tx_hash, payer, amount: Union[int, str]):
     )
 
 
-async def confirm_withdraw(tx_hash, db, user_id, withdraw):
+async def confirm_withdraw(tx_hash, user_id, withdraw):
     """Ensure withdraw transaction is successful to update credits user. \n
     Can raise an OperationNotFound exception if transaction is not found.
     """
@@ -101,11 +251,14 @@ async def confirm_withdraw(tx_hash, db, user_id, withdraw):
     credit_update = schemas.CreditUpdate(
         id=withdraw.id, amount=-withdraw.amount, owner_id=user_id, operation_hash=""
     )
-    crud.update_credits(db, credit_update)
+    # The session of the request is closed by now
+    async with database.AsyncSessionLocal() as db:
+        await crud.update_credits(db, credit_update)
 
 
-def simulate_transaction(operations):
-    op = ptz.bulk(
+def build_transaction(operations):
+    """Returns the operations as sent by the API, not autofilled."""
+    return ptz.bulk(
         *[
             ptz.transaction(
                 source=ptz.key.public_key_hash(),
@@ -116,31 +269,290 @@ def simulate_transaction(operations):
             for operation in operations
         ]  # type: ignore
     )
-    return op.autofill()
 
 
-def get_public_key(address):
+simulation_cache = SimulationCache(config.SIMULATION_CACHE_SIZE)
+
+
+def simulation_scope():
+    head = nodes.head()
+    if head is None:
+        return None
+    if config.SIMULATION_CACHE_SCOPE == "head":
+        return int(head["level"])
+    return head["protocol"]
+
+
+PROFILES_CHANNEL = "entrypoint_profiles"
+# Counter of the operations estimated without the node: forged at least as
+# large as a real one, so that they are not packed too tightly. The batch
+# gets its own counters anyway.
+PLACEHOLDER_COUNTER = 2**35 - 1
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class EntrypointProfiles:
+    """Gas used, storage used and fee of the last `window` calls of each
+    (contract, entrypoint), from the receipts of the injected batches. The
+    batchers record the samples in the database, from which they are loaded
+    at startup, and publish them to the running processes."""
+
+    def __init__(self, window, min_samples):
+        self.min_samples = min_samples
+        self.window = window
+        self.samples = dict()  # (contract, entrypoint) -> deque of samples
+        self.listening = False
+        # Samples notified while the profiles are loaded, None otherwise
+        self.received = None
+
+    def add(self, destination, entrypoint, gas, storage, fee):
+        key = (destination, entrypoint)
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+        self.samples[key].append((gas, storage, fee))
+
+    def estimate(self, destination, entrypoint, p=99):
+        """Returns the p-th percentile of the gas, storage and fee of the
+        entrypoint, or None if it has not been called enough."""
+        samples = self.samples.get((destination, entrypoint), ())
+        if len(samples) < max(1, self.min_samples):
+            return None
+        return tuple(percentile(values, p) for values in zip(*samples))
+
+    def on_notification(self, payload):
+        for sample in json.loads(payload):
+            self.add(*sample)
+            if self.received is not None:
+                self.received.append(sample)
+
+    async def load(self):
+        """Reads the last samples recorded by the batchers, so that a process
+        does not start without profiles. The samples notified while they are
+        read are added back after them, as they are the most recent ones."""
+        self.received = []
+        try:
+            async with database.AsyncSessionLocal() as db:
+                rows = await crud.get_entrypoint_samples(db, self.window)
+        except Exception as e:
+            log.error(f"Could not load the entrypoint profiles : {e}")
+            return
+        finally:
+            received, self.received = self.received, None
+        self.samples = dict()
+        for sample in list(rows) + received:
+            self.add(*sample)
+        log.info(f"Loaded the profiles of {len(self.samples)} entrypoints")
+
+    def on_listening(self, listening):
+        self.listening = listening
+        # Also reloaded after a reconnection, as samples may have been missed
+        if listening:
+            asyncio.ensure_future(self.load())
+
+    async def listen(self):
+        """Receives the samples published by the batchers, which may run in
+        other processes."""
+        await database.listen(PROFILES_CHANNEL, self.on_notification, self.on_listening)
+
+
+entrypoint_profiles = EntrypointProfiles(
+    config.ENTRYPOINT_PROFILE_WINDOW, config.ENTRYPOINT_PROFILE_MIN_SAMPLES
+)
+
+
+def receipt_samples(op_result):
+    """Returns the (contract, entrypoint, gas, storage, fee) of each contract
+    call of an operation group receipt. The fee is the one the call would
+    pay alone, as the batch fee is only set on its first operation."""
+    thresholds = ptz.context.get_fee_thresholds()
+    samples = []
+    for content in op_result["contents"]:
+        # Transfers to implicit accounts are withdrawals
+        if content["kind"] != "transaction" or content["destination"].startswith("tz"):
+            continue
+        gas = OperationResult.consumed_gas(content)
+        storage = OperationResult.paid_storage_size_diff(content)
+        storage += OperationResult.burned(content)
+        fee = calculate_fee(
+            {k: v for k, v in content.items() if k != "metadata"},
+            gas + DEFAULT_GAS_RESERVE,
+            extra_size=1 + 32 + 64,
+            thresholds=thresholds,
+        )
+        entrypoint = content.get("parameters", {}).get("entrypoint", "default")
+        samples.append((content["destination"], entrypoint, gas, storage, fee))
+    return samples
+
+
+def estimate_transaction(operations):
+    """Builds the operations as sent by the API from the profiles of their
+    entrypoints, without simulating them. Returns None unless profiles are
+    enabled and all the entrypoints are well known."""
+    if not config.ENTRYPOINT_PROFILES:
+        return None
+    estimates = [
+        entrypoint_profiles.estimate(
+            operation["destination"], operation["parameters"]["entrypoint"]
+        )
+        for operation in operations
+    ]
+    head = nodes.head()
+    if head is None or any(estimate is None for estimate in estimates):
+        return None
+    op = build_transaction(operations)
+    contents = [
+        {
+            **content,
+            "counter": str(PLACEHOLDER_COUNTER),
+            "gas_limit": str(gas + DEFAULT_GAS_RESERVE),
+            "storage_limit": str(storage + DEFAULT_BURN_RESERVE),
+            "fee": str(fee),
+        }
+        for content, (gas, storage, fee) in zip(op.contents, estimates)
+    ]
+    return ptz.operation_group(branch=head["hash"], contents=contents)
+
+
+async def simulate_transaction(operations):
+    """Autofills the operations as sent by the API. Identical calls reuse
+    the estimates of the last simulation in the same scope; their group is
+    validated again anyway when the batch is simulated."""
+    scope = simulation_scope()
+    key = SimulationCache.key(operations)
+    cached = simulation_cache.get(scope, key)
+    if cached is not None:
+        branch, contents = cached
+        return ptz.operation_group(branch=branch, contents=copy.deepcopy(contents))
+    op = build_transaction(operations)
+    op = await rpc.run(op.autofill)
+    simulation_cache.set(scope, key, (op.branch, copy.deepcopy(op.contents)))
+    return op
+
+
+class PublicKeyCache:
+    """Manager public keys by address. A revealed key never changes and is
+    kept for good; an account that is not revealed yet is only remembered
+    as such for `negative_ttl` seconds."""
+
+    def __init__(self, negative_ttl):
+        self.negative_ttl = negative_ttl
+        self.keys = dict()
+        self.unrevealed = dict()  # address -> expiry
+
+    def set(self, address, key):
+        if key is None:
+            self.unrevealed[address] = time.monotonic() + self.negative_ttl
+        else:
+            self.keys[address] = key
+            self.unrevealed.pop(address, None)
+
+    def is_unrevealed(self, address):
+        expiry = self.unrevealed.get(address)
+        if expiry is not None and expiry <= time.monotonic():
+            del self.unrevealed[address]
+            return False
+        return expiry is not None
+
+
+public_keys = PublicKeyCache(config.PUBLIC_KEY_NEGATIVE_TTL)
+
+
+async def get_public_key(address):
+    """Returns the manager public key of `address`, or None if it is not
+    revealed; the node is only asked when it is not cached."""
     assert address.startswith("tz")
-    key = ptz.shell.head.context.contracts[address].manager_key()
+    if address in public_keys.keys:
+        return public_keys.keys[address]
+    if public_keys.is_unrevealed(address):
+        return None
+    key = await rpc.run(ptz.shell.head.context.contracts[address].manager_key)
+    public_keys.set(address, key)
     return key
 
 
-def check_signature(pair_data, signature, public_key, pair_type=None):
-    if pair_type is None:
-        # Type of a withdraw operation
-        pair_type = {
-            "prim": "pair",
-            "args": [{"prim": "string"}, {"prim": "int"}, {"prim": "mutez"}],
-        }
-    public_key = pytezos.Key.from_encoded_key(public_key)
-    matcher = MichelsonType.match(pair_type)
-    packed_pair = matcher.from_micheline_value(pair_data).pack()
-    try:
-        # .verify raises an exception when the verification fails
-        return public_key.verify(message=packed_pair, signature=signature)
-    except ValueError:
+class SignatureVerifier:
+    """Verifies signatures in a pool of worker processes, as the checks are
+    CPU-bound. The checks requested during the same iteration of the event
+    loop are sent together, split in one batch per worker."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = self.create_executor()
+        self.pending = []  # (check, future)
+
+    def create_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def restart(self, executor):
+        """Replaces a broken executor, unless another batch already did."""
+        if self.executor is executor:
+            log.warning("A signature worker died, restarting the workers")
+            self.executor = self.create_executor()
+            executor.shutdown(wait=False)
+
+    def verify(self, *check):
+        loop = asyncio.get_running_loop()
+        if len(self.pending) == 0:
+            loop.call_soon(self.flush)
+        future = loop.create_future()
+        self.pending.append((check, future))
+        return future
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        size = math.ceil(len(pending) / self.workers)
+        for i in range(0, len(pending), size):
+            asyncio.ensure_future(self.verify_batch(pending[i : i + size]))
+
+    async def verify_batch(self, batch, retry=True):
+        executor = self.executor
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                executor, signatures.verify_batch, [check for check, _ in batch]
+            )
+        except BrokenProcessPool as e:
+            # A worker died (out of memory, crash in the crypto library): the
+            # executor refuses any later work, so it is replaced and the
+            # batch is retried once.
+            self.restart(executor)
+            if retry:
+                await self.verify_batch(batch, retry=False)
+                return
+            results = [e] * len(batch)
+        except Exception as e:
+            if len(batch) > 1:
+                # The batch failed as a whole, e.g. when one of the results
+                # cannot be sent back: each check is retried alone, so that
+                # it only fails its own caller.
+                for item in batch:
+                    asyncio.ensure_future(self.verify_batch([item]))
+                return
+            results = [e]
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+signature_verifier = SignatureVerifier(config.SIGNATURE_WORKERS)
+
+
+async def check_signature(pair_data, signature, public_key, pair_type=None):
+    is_valid = await signature_verifier.verify(
+        pair_data, signature, public_key, pair_type
+    )
+    if not is_valid:
         log.error(f"Signature {signature} for {public_key} is not valid.")
-        return False
+    return is_valid
 
 
 def public_key_hash(public_key: str):
@@ -149,44 +561,182 @@ def public_key_hash(public_key: str):
 
 
 async def withdraw(tezos_manager, to, amount):
-    op = ptz.transaction(
-        source=ptz.key.public_key_hash(), destination=to, amount=amount
-    ).autofill()
-    return await tezos_manager.queue_operation(sender=to, operation=op)
+    op = await rpc.run(
+        ptz.transaction(
+            source=ptz.key.public_key_hash(), destination=to, amount=amount
+        ).autofill
+    )
+    # Only the admin account holds the funds to withdraw
+    return await tezos_manager.admin.queue_operation(sender=to, operation=op)
+
+
+# Channel on which the batchers publish the results of the outbox operations
+OUTBOX_CHANNEL = "outbox"
+# Interval (in seconds) between two purges of the finished outbox operations
+OUTBOX_PURGE_INTERVAL = 3600
+# Notification payloads are limited to 8000 bytes
+MAX_ERROR_LENGTH = 1000
 
 
 class TezosManager:
     def __init__(self, ptz):
+        # Operations and results are keyed by a per-submission id, so that
+        # a sender can have several operations in flight.
+        # Queued operations are persisted in the outbox table, which is what
+        # the batches are built from; ops_queue only mirrors the operations
+        # submitted through this process.
         self.ops_queue = OrderedDict()
-        self.results = dict()  # TODO: find inspiration
+        self.senders = dict()
+        self.queued_by_sender = dict()
+        # Futures of the callers still waiting for their operation
+        self.waiters = dict()
         self.ptz = ptz
+        self.address = ptz.key.public_key_hash()
+        self.counters = CounterManager(ptz)
         self.block_time = int(constants["minimal_block_delay"])
+        self.last_level = None
+        # Connection holding the advisory lock of the relayer, if this
+        # process is its active batcher
+        self.lock_connection = None
+        self.next_purge = 0.0
+        # (hash, counter, expiry level) of the last batch injected by this
+        # process, until it is included or expires: the next batch would
+        # conflict with it in the mempool.
+        self.in_flight = None
+
+    def is_queued(self, sender):
+        return sender in self.queued_by_sender
 
     # Receive an operation from sender and add it to the waiting queue;
-    # blocks until there is a result in self.results
-    async def queue_operation(self, sender, operation):
-        self.results[sender] = "waiting"
-        self.ops_queue[sender] = operation
-        while self.results[sender] == "waiting":
-            # TODO wait the right amount of time
-            # FIXME add max waiting time
-            await asyncio.sleep(1)
-
-        if self.results[sender] == "waiting":
+    # blocks until main_loop resolves the future stored in self.waiters
+    async def queue_operation(self, sender, operation, vault_id=None):
+        key = uuid.uuid4()
+        # Waiting before the operation is written, so that its result cannot
+        # be published before it is awaited
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[key] = waiter
+        self.senders[key] = sender
+        self.queued_by_sender[sender] = self.queued_by_sender.get(sender, 0) + 1
+        self.ops_queue[key] = operation
+        try:
+            async with database.AsyncSessionLocal() as db:
+                await crud.create_outbox_operation(
+                    db,
+                    schemas.CreateOutboxOperation(
+                        id=key,
+                        sender=sender,
+                        relayer=self.address,
+                        branch=operation.branch,
+                        contents=operation.contents,
+                        vault_id=vault_id,
+                    ),
+                )
+            # The future is resolved (or failed) by main_loop as soon as
+            # the batch containing this operation is injected or rejected.
+            result = await asyncio.wait_for(waiter, config.MAX_WAITING_TIME)
+        except asyncio.TimeoutError as e:
             log.error(f"Still waiting for transaction from {sender}... Abort")
-            raise Exception()
+            async with database.AsyncSessionLocal() as db:
+                await crud.cancel_outbox_operation(db, key)
+            raise OperationTimeout(sender) from e
+        finally:
+            self.waiters.pop(key)
+            self._dequeue(key)
 
         return {
             "result": "ok",
-            "transaction_hash": self.results[sender]["transaction"].hash(),
+            "transaction_hash": result["hash"],
         }
 
-    async def update_fees(self, posted_tx):
-        op_result = await find_transaction(posted_tx.hash())
-        fees = find_fees(op_result, ptz.key.public_key_hash())
+    def _dequeue(self, key):
+        sender = self.senders.pop(key, None)
+        if sender is not None:
+            self.queued_by_sender[sender] -= 1
+            if self.queued_by_sender[sender] == 0:
+                del self.queued_by_sender[sender]
+        return self.ops_queue.pop(key, None)
+
+    def _resolve(self, db, key, op_hash=None, index=None, error=None):
+        """Records the result of `key` in the outbox and returns it, so that
+        its caller is woken up once the batch is committed. The error is
+        returned as the OperationFailed its caller gets from a notification,
+        so that it does not depend on which process runs the batcher."""
+        status = "failed" if error is not None else "injected"
+        result = {"hash": op_hash, "status": status, "index": index}
+        message = None if error is None else str(error)[:MAX_ERROR_LENGTH]
+        crud.update_outbox_operation(
+            db, key, schemas.OutboxStatus[status.upper()], op_hash, index
+        )
+        # Callers waiting in other processes are woken up on commit
+        crud.notify(
+            db,
+            OUTBOX_CHANNEL,
+            json.dumps({"id": str(key), **result, "error": message}),
+        )
+        return key, result, None if message is None else OperationFailed(message)
+
+    def _wake(self, key, result, error=None):
+        waiter = self.waiters.get(key)
+        if waiter is None:
+            # Submitted through another process
+            return
+        self._dequeue(key)
+        if waiter.done():
+            return
+        if error is not None:
+            waiter.set_exception(error)
+        else:
+            waiter.set_result(result)
+
+    def on_notification(self, key, notification):
+        """Wakes up the caller of `key` from a result published by the
+        batcher, which may run in another process."""
+        result = {k: notification[k] for k in ("hash", "status", "index")}
+        error = notification["error"]
+        self._wake(key, result, None if error is None else OperationFailed(error))
+
+    def is_leader(self):
+        """Takes, or checks that this process still holds, the advisory lock
+        which makes it the only batcher of the relayer."""
+        try:
+            if self.lock_connection is None:
+                self.lock_connection = database.try_advisory_lock(self.address)
+                if self.lock_connection is not None:
+                    log.info(f"Elected as batcher for {self.address}")
+                    # The previous batcher may have used more counters
+                    self.counters.counter = None
+                    self.in_flight = None
+            else:
+                # The lock is lost with the connection holding it
+                database.ping(self.lock_connection)
+        except Exception as e:
+            log.error(f"Lost the batcher lock for {self.address} : {e}")
+            if self.lock_connection is not None:
+                self.lock_connection.invalidate()
+            self.lock_connection = None
+        return self.lock_connection is not None
+
+    async def update_fees(self, op_hash):
+        op_result = await find_transaction(op_hash)
+        fees = find_fees(op_result, self.ptz.key.public_key_hash())
         fees = group_fees(fees)
+        samples = []
+        if config.ENTRYPOINT_PROFILES:
+            # Reads the fee thresholds from the node
+            samples = await rpc.run(receipt_samples, op_result)
+        await rpc.run(self.record_fees, op_hash, fees, samples)
+
+    def record_fees(self, op_hash, fees, samples):
+        """Blocking, so run in the RPC thread pool like the batches."""
         try:
             db = database.SessionLocal()
+            # Only collected when the profiles are enabled
+            if len(samples) > 0:
+                crud.create_entrypoint_samples(db, samples, entrypoint_profiles.window)
+            # Notifications are limited to 8000 bytes
+            for i in range(0, len(samples), 50):
+                crud.notify(db, PROFILES_CHANNEL, json.dumps(samples[i : i + 50]))
+            db.commit()
             for contract, fee in fees.items():
                 # If this is a transfer to a tz1, then it's a withdraw
                 # and the fees do not matter.
@@ -197,52 +747,370 @@ class TezosManager:
                     db, amount=fee, address=contract
                 )
 
-                crud.update_amount_operation(db, posted_tx.hash(), fee)
+                crud.update_amount_operation(db, op_hash, fee)
 
         finally:
             db.close()
 
-    async def main_loop(self):
+    async def wait_for_new_head(self):
+        """Polls the node until a block newer than the last processed one
+        is found and returns its level."""
         while True:
+            level = int((await rpc.run(self.ptz.shell.head.header))["level"])
+            if self.last_level is None or level > self.last_level:
+                if self.last_level is not None and level > self.last_level + 1:
+                    log.warning(
+                        f"Missed {level - self.last_level - 1} block(s) before {level}"
+                    )
+                self.last_level = level
+                return level
+            await asyncio.sleep(config.HEAD_POLLING_INTERVAL)
+
+    def send_batch(self):
+        """Sends a batch of the pending outbox operations. Blocking, so run in
+        the RPC thread pool; returns the results of the processed operations
+        and the injected operation group, if any."""
+        db = database.SessionLocal()
+        try:
+            # The claimed rows stay locked until the batch is committed as
+            # SENDING, so that no other batcher sends them; pending rows left
+            # by a previous run are claimed like the others.
+            rows = crud.claim_outbox_operations(db, self.address)
+            log.debug(f"found {len(rows)} operations to send")
+            operations = [
+                (
+                    row.id,
+                    self.ptz.operation_group(branch=row.branch, contents=row.contents),
+                )
+                for row in rows
+            ]
+            senders = {row.id: row.sender for row in rows}
+            packed = pack_operations(operations, senders, constants)
+            # What does not fit in this batch stays pending for the next one
+            if len(rows) > len(packed):
+                log.info(
+                    f"{len(rows) - len(packed)} operations postponed to next batch"
+                )
+            # Read by the admission control of the API processes
+            if len(packed) > 0:
+                crud.update_relayer_batch_size(db, self.address, len(packed))
+            outcomes, posted_tx = self._send_operations(db, packed)
+            db.commit()
+            return outcomes, posted_tx
+        finally:
+            db.close()
+
+    def simulate_batch(self, operations):
+        """Autofills the operations as one group sent by this relayer, with
+        the local counter and branch, resyncing the counter once if the
+        node refuses it."""
+        for retry in (True, False):
+            operation_group = self.ptz.operation_group(
+                branch=self.counters.branch,
+                contents=self.ptz.bulk(*operations).contents,
+            )
             try:
-                await asyncio.sleep(self.block_time)
-                # TODO make sure we are in a new block, otherwise continue
-                # TODO catch errors
-
-                n_ops = len(self.ops_queue)
-                log.debug(f"found {n_ops} operations to send")
-                acceptable_operations = OrderedDict()
-                for sender in self.ops_queue:
-                    op = self.ops_queue[sender]
-                    acceptable_operations[sender] = op
-                    try:
-                        ptz.bulk(*acceptable_operations.values()).autofill()
-                    except MichelsonError:
-                        # The last operation conflicts with some of the others;
-                        # we refuse it
-                        log.error(
-                            f"Last operation ({acceptable_operations[sender]}) failed and conflicts with some of the others so we discard it."
+                return operation_group.autofill(counter=self.counters.next_counter())
+            except RpcError as e:
+                if not (retry and is_counter_error(e)):
+                    raise
+                log.warning(f"Counter of {self.address} is out of sync : {e}")
+                self.counters.resync()
+
+    def inject_batch(self, db, simulated, operations):
+        """Signs and injects the batch of the (key, operation). The operations
+        are committed as SENDING, with the hash of the batch, before it is
+        injected: if the injection is not confirmed, the batch is looked up
+        on chain instead of being sent again."""
+        for retry in (True, False):
+            posted_tx = simulated.sign()
+            op_hash = posted_tx.hash()
+            counter = int(posted_tx.contents[-1]["counter"])
+            for index, (key, _) in enumerate(operations):
+                crud.send_outbox_operation(
+                    db, key, op_hash, index, counter, self.counters.expiry_level
+                )
+            db.commit()
+            try:
+                posted_tx.inject()
+                break
+            except RpcError as e:
+                if not (retry and is_counter_error(e)):
+                    raise
+                log.warning(f"Counter of {self.address} is out of sync : {e}")
+                self.counters.resync()
+                simulated = self.simulate_batch([op for _, op in operations])
+        self.counters.injected(len(posted_tx.contents))
+        self.in_flight = (op_hash, counter, self.counters.expiry_level)
+        return posted_tx
+
+    def _send_operations(self, db, packed):
+        try:
+            accepted, simulated, rejected = validate_operations(
+                self.simulate_batch, [], packed
+            )
+        except Exception as e:
+            log.error(f"Could not validate batch : {e}")
+            return [self._resolve(db, key, error=e) for key, _ in packed], None
+        outcomes = []
+        for key, e in rejected:
+            # The operation conflicts with some of the others; we refuse it
+            log.error(
+                f"Operation ({dict(packed)[key]}) failed and conflicts with some of the others so we discard it."
+            )
+            outcomes.append(self._resolve(db, key, error=e))
+        acceptable_operations = OrderedDict(accepted)
+        posted_tx = None
+
+        n_ops = len(acceptable_operations)
+        log.debug(f"found {n_ops} valid operations to send")
+        if n_ops > 0:
+            log.info(f"{n_ops} operations to process and send")
+            # Post all the correct operations together and get the
+            # result from the RPC to know what the real fees were.
+            # The limits and fees come from the last successful simulation
+            # of the batch, so it is not simulated again before injection.
+            try:
+                posted_tx = self.inject_batch(
+                    db, simulated, list(acceptable_operations.items())
+                )
+            except RpcError as e:
+                posted_tx = None
+                if is_conflict_error(e) or is_counter_error(e):
+                    # Not caused by the operations, which are sent again in
+                    # a later batch
+                    log.warning(f"Batch of {self.address} refused : {e}")
+                    self.counters.resync()
+                    for k in acceptable_operations:
+                        crud.update_outbox_operation(
+                            db, k, schemas.OutboxStatus.PENDING
                         )
-                        acceptable_operations.pop(sender)
-                        self.results[sender] = "failing"
-
-                n_ops = len(acceptable_operations)
-                log.debug(f"found {n_ops} valid operations to send")
-                if n_ops > 0:
-                    log.info(f"{n_ops} operations to process and send")
-                    # Post all the correct operations together and get the
-                    # result from the RPC to know what the real fees were
-                    posted_tx = ptz.bulk(*acceptable_operations.values()).send()
-                    for i, k in enumerate(acceptable_operations):
-                        assert self.results[k] != "failing"
-                        self.results[k] = {"transaction": posted_tx}
-                    asyncio.create_task(self.update_fees(posted_tx))
-                self.ops_queue = dict()
-                log.debug("Tezos loop executed")
+                else:
+                    # Refused by the node
+                    log.error(f"Could not inject batch : {e}")
+                    for k in acceptable_operations:
+                        outcomes.append(self._resolve(db, k, error=e))
+            except Exception as e:
+                # The batch may have reached the node anyway: its operations
+                # stay SENDING until it is found on chain or expires.
+                log.error(f"Injection of the batch is not confirmed : {e}")
+                posted_tx = None
+            else:
+                op_hash = posted_tx.hash()
+                for index, k in enumerate(acceptable_operations):
+                    outcomes.append(self._resolve(db, k, op_hash, index))
+        return outcomes, posted_tx
+
+    def sending_batches(self):
+        """Returns the (counter, expiry level) of the batches whose injection
+        is not confirmed, by their hash."""
+        db = database.SessionLocal()
+        try:
+            return {
+                row.hash: (row.counter, row.expiry_level)
+                for row in crud.get_sending_outbox_operations(db, self.address)
+            }
+        finally:
+            db.close()
+
+    def settle_batch(self, op_hash, included):
+        """Marks the SENDING operations of the batch `op_hash` as injected if
+        it is included, and puts them back in the queue otherwise."""
+        db = database.SessionLocal()
+        try:
+            outcomes = []
+            if included:
+                for row in crud.get_sending_outbox_operations(
+                    db, self.address, op_hash
+                ):
+                    outcomes.append(self._resolve(db, row.id, op_hash, row.batch_index))
+            else:
+                crud.requeue_outbox_operations(db, self.address, op_hash)
+                # The local counter counted the batch
+                self.counters.resync()
+            db.commit()
+            return outcomes
+        finally:
+            db.close()
+
+    async def is_included(self, op_hash, counter):
+        """Whether the batch `op_hash`, whose last operation uses `counter`,
+        is included: it is looked up in the recent blocks, and the counter of
+        the relayer tells it for the older ones."""
+        if await inclusion_tracker.is_included(op_hash):
+            return True
+        return await rpc.run(self.counters.chain_counter) >= counter
+
+    async def recover(self, level):
+        """Settles the batches whose injection was not confirmed, by this
+        batcher or a previous one, and the last batch injected by this one.
+        Returns False while one of them can still be included, as the next
+        batch would conflict with it."""
+        batches = await rpc.run(self.sending_batches)
+        if self.in_flight is not None:
+            op_hash, counter, expiry_level = self.in_flight
+            batches.setdefault(op_hash, (counter, expiry_level))
+        for op_hash, (counter, expiry_level) in batches.items():
+            if await self.is_included(op_hash, counter):
+                log.debug(f"Batch {op_hash} was included")
+                included = True
+            elif level > expiry_level:
+                log.warning(f"Batch {op_hash} expired without being included")
+                included = False
+            else:
+                log.info(f"Waiting for batch {op_hash} to be included or expire")
+                return False
+            outcomes = await rpc.run(self.settle_batch, op_hash, included)
+            for key, result, error in outcomes:
+                self._wake(key, result, error)
+            # The fees of the batches injected by this process are already
+            # being recorded
+            if included and len(outcomes) > 0:
+                asyncio.create_task(self.update_fees(op_hash))
+            if self.in_flight is not None and self.in_flight[0] == op_hash:
+                self.in_flight = None
+        return True
+
+    def purge_outbox(self):
+        before = None
+        if config.OUTBOX_RETENTION > 0:
+            before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+                seconds=config.OUTBOX_RETENTION
+            )
+        db = database.SessionLocal()
+        try:
+            count = crud.purge_outbox_operations(
+                db, self.address, before, config.OUTBOX_MAX_FINISHED
+            )
+            db.commit()
+            log.debug(f"Purged {count} finished outbox operations")
+        finally:
+            db.close()
+
+    async def main_loop(self):
+        while True:
+            try:
+                # At most one batch per block: wait for a new head, then
+                # leave some time for operations to accumulate before sending.
+                level = await self.wait_for_new_head()
+                # Only one process sends the batches of a given relayer
+                if not await rpc.run(self.is_leader):
+                    continue
+                await rpc.run(self.counters.set_head, level)
+                if not await self.recover(level):
+                    continue
+                purge = config.OUTBOX_RETENTION > 0 or config.OUTBOX_MAX_FINISHED > 0
+                if purge and time.monotonic() >= self.next_purge:
+                    self.next_purge = time.monotonic() + OUTBOX_PURGE_INTERVAL
+                    await rpc.run(self.purge_outbox)
+                await asyncio.sleep(config.BATCH_OFFSET)
+                outcomes, posted_tx = await rpc.run(self.send_batch)
+                # Callers are woken up once their results are committed
+                for key, result, error in outcomes:
+                    self._wake(key, result, error)
+                if posted_tx is not None:
+                    asyncio.create_task(self.update_fees(posted_tx.hash()))
+                log.debug(f"Tezos loop executed for block {level}")
             except Exception as e:
                 # FIXME: Should we raise an Exception here ?
                 log.error(f"Error occurred on main loop : {e}")
-                pass
+                await asyncio.sleep(config.HEAD_POLLING_INTERVAL)
+
+
+class RelayerPool:
+    """Dispatches operations between the TezosManager of each relayer key,
+    so that one batch per relayer can be injected in each block."""
+
+    def __init__(self, clients):
+        self.managers = [TezosManager(client) for client in clients]
+        self.admin = self.managers[0]
+        self.listening = False
+
+    async def queue_operation(self, sender, operation, vault_id=None):
+        # A sender already queued on a relayer stays on it, so that its
+        # operations are injected in order.
+        manager = next(
+            (m for m in self.managers if m.is_queued(sender)),
+            min(self.managers, key=lambda m: len(m.ops_queue)),
+        )
+        return await manager.queue_operation(sender, operation, vault_id)
+
+    async def retry_after(self, db, depth):
+        """Estimates, in seconds, the time needed to drain `depth` queued
+        operations from the size of the last batches of the relayers."""
+        sizes = await crud.get_relayer_batch_sizes(db)
+        per_block = sum(max(1, sizes.get(m.address, 0)) for m in self.managers)
+        return self.admin.block_time * max(1, math.ceil(depth / per_block))
+
+    async def admission(self, vault_id):
+        """Refuses a new operation when the queues are full or when the vault
+        already has too many operations in flight; 0 disables a limit. The
+        operations are counted in the outbox, so that the limits hold for all
+        the API processes together."""
+        if config.MAX_QUEUE_DEPTH <= 0 and config.MAX_IN_FLIGHT_PER_VAULT <= 0:
+            return
+        async with database.AsyncSessionLocal() as db:
+            depths = await crud.get_outbox_queue_depths(
+                db, [manager.address for manager in self.managers]
+            )
+            depth = sum(depths.values())
+            if 0 < config.MAX_QUEUE_DEPTH <= depth:
+                raise QueueFull(await self.retry_after(db, depth))
+            if config.MAX_IN_FLIGHT_PER_VAULT > 0:
+                in_flight = await crud.count_vault_outbox_operations(db, vault_id)
+                if config.MAX_IN_FLIGHT_PER_VAULT <= in_flight:
+                    raise TooManyOperationsInFlight(await self.retry_after(db, depth))
+
+    def on_notification(self, payload):
+        notification = json.loads(payload)
+        key = uuid.UUID(notification["id"])
+        for manager in self.managers:
+            manager.on_notification(key, notification)
+
+    def on_listening(self, listening):
+        self.listening = listening
+        # Results published while the connection was lost are missed
+        if listening:
+            asyncio.ensure_future(self.catch_up())
+
+    async def catch_up(self):
+        """Wakes up the callers whose result was published while the
+        connection was lost, from the outbox."""
+        keys = [key for manager in self.managers for key in manager.waiters]
+        if len(keys) == 0:
+            return
+        try:
+            async with database.AsyncSessionLocal() as db:
+                rows = await crud.get_outbox_operations(db, keys)
+        except Exception as e:
+            log.error(f"Could not read the results of the outbox : {e}")
+            return
+        for row in rows:
+            if row.status not in (
+                schemas.OutboxStatus.INJECTED,
+                schemas.OutboxStatus.FAILED,
+            ):
+                continue
+            notification = {
+                "hash": row.hash,
+                "status": row.status.value.lower(),
+                "index": row.batch_index,
+                "error": (
+                    f"Operation {row.id} failed"
+                    if row.status == schemas.OutboxStatus.FAILED
+                    else None
+                ),
+            }
+            for manager in self.managers:
+                manager.on_notification(row.id, notification)
+
+    async def listen_results(self):
+        """Receives the results of the operations queued from this process
+        when the batches are sent by another one."""
+        await database.listen(OUTBOX_CHANNEL, self.on_notification, self.on_listening)
+
+    async def main_loop(self):
+        await asyncio.gather(*[manager.main_loop() for manager in self.managers])
 
 
-tezos_manager = TezosManager(ptz)
+tezos_manager = RelayerPool(relayers)
@@ -32,6 +32,26 @@ class OperationNotFound(Exception):
     pass
 
 
+class OperationTimeout(Exception):
+    pass
+
+
+class OperationFailed(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class TooManyOperationsInFlight(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
 class ContractAlreadyRegistered(Exception):
     pass
 
@@ -0,0 +1,18 @@
+"""Standalone batcher, run with `python -m src.worker`.
+
+The API processes (started with EMBEDDED_BATCHER=false) only write the
+operations to the outbox; this worker builds and sends the batches. Several
+workers can run at the same time: an advisory lock per relayer ensures that
+only one of them sends its batches, the others taking over if it stops.
+"""
+import asyncio
+
+from . import tezos
+
+
+async def main():
+    await asyncio.gather(tezos.nodes.monitor(), tezos.tezos_manager.main_loop())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
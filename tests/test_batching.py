@@ -0,0 +1,243 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from pytezos.operation import MAX_OPERATIONS_TTL
+from pytezos.rpc.errors import MichelsonError, RpcError
+import pytest
+
+from src import batching
+
+
+# 96 bytes are taken by the branch and the signature of the group
+CONSTANTS = {
+    "hard_gas_limit_per_operation": "1000",
+    "hard_storage_limit_per_operation": "100",
+    "max_operation_data_length": str(96 + 300),
+}
+
+
+def operation(gas=0, storage=0, size=10):
+    return SimpleNamespace(
+        contents=[{"gas_limit": str(gas), "storage_limit": str(storage)}],
+        # Forged with its own 32 bytes branch
+        forge=lambda: "00" * (32 + size),
+    )
+
+
+def error(id):
+    return RpcError({"id": id, "kind": "temporary"})
+
+
+def simulator(bad, error):
+    """Simulates the operations, failing with `error` if one of them is in
+    `bad`; the simulated group is the tuple of the operations."""
+
+    def simulate(operations):
+        simulate.calls += 1
+        if any(op in bad for op in operations):
+            raise error
+        return tuple(operations)
+
+    simulate.calls = 0
+    return simulate
+
+
+def client(counter=41, ttl=60):
+    client = MagicMock()
+    client.key.public_key_hash.return_value = "tz1relayer"
+    client.shell.contracts.__getitem__.return_value.return_value = {
+        "counter": str(counter)
+    }
+    client.context.get_operations_ttl.return_value = ttl
+    client.shell.blocks.__getitem__.return_value.hash.return_value = "BLbranch"
+    return client
+
+
+# pack_operations
+
+
+def test_pack_operations_within_gas_limit():
+    operations = [(i, operation(gas=400)) for i in range(3)]
+    senders = {i: f"tz1sender{i}" for i in range(3)}
+    packed = batching.pack_operations(operations, senders, CONSTANTS)
+    assert [key for key, _ in packed] == [0, 1]
+
+
+def test_pack_operations_within_storage_and_size_limits():
+    operations = [
+        ("a", operation(storage=60)),
+        ("b", operation(storage=60)),
+        ("c", operation(size=300)),
+        ("d", operation(size=20)),
+    ]
+    senders = {key: f"tz1{key}" for key, _ in operations}
+    packed = batching.pack_operations(operations, senders, CONSTANTS)
+    assert [key for key, _ in packed] == ["a", "d"]
+
+
+def test_pack_operations_keeps_sender_order():
+    operations = [
+        ("a1", operation(gas=100)),
+        ("a2", operation(gas=950)),
+        ("a3", operation(gas=10)),
+        ("b1", operation(gas=10)),
+    ]
+    senders = {"a1": "tz1a", "a2": "tz1a", "a3": "tz1a", "b1": "tz1b"}
+    packed = batching.pack_operations(operations, senders, CONSTANTS)
+    # a3 waits for a2, which does not fit
+    assert [key for key, _ in packed] == ["a1", "b1"]
+
+
+def test_pack_operations_always_selects_the_first_one():
+    operations = [("a", operation(gas=5000)), ("b", operation(gas=10))]
+    senders = {"a": "tz1a", "b": "tz1b"}
+    packed = batching.pack_operations(operations, senders, CONSTANTS)
+    assert [key for key, _ in packed] == ["a"]
+
+
+# validate_operations
+
+
+def test_validate_operations_without_conflict():
+    candidates = [(i, f"op{i}") for i in range(8)]
+    simulate = simulator(bad=set(), error=None)
+    accepted, simulated, rejected = batching.validate_operations(
+        simulate, [], candidates
+    )
+    assert accepted == candidates
+    assert simulated == tuple(op for _, op in candidates)
+    assert rejected == []
+    assert simulate.calls == 1
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [
+        MichelsonError({"id": "proto.018-Proxford.michelson_v1.script_rejected"}),
+        error("proto.018-Proxford.contract.balance_too_low"),
+        error("proto.018-Proxford.tez.subtraction_underflow"),
+    ],
+)
+def test_validate_operations_bisects_operation_errors(failure):
+    candidates = [(i, f"op{i}") for i in range(8)]
+    simulate = simulator(bad={"op2", "op5"}, error=failure)
+    accepted, simulated, rejected = batching.validate_operations(
+        simulate, [], candidates
+    )
+    assert [key for key, _ in accepted] == [0, 1, 3, 4, 6, 7]
+    assert simulated == ("op0", "op1", "op3", "op4", "op6", "op7")
+    assert rejected == [(2, failure), (5, failure)]
+    assert simulate.calls < len(candidates) + 4
+
+
+def test_validate_operations_rejects_everything():
+    candidates = [(i, f"op{i}") for i in range(2)]
+    failure = error("proto.018-Proxford.contract.balance_too_low")
+    simulate = simulator(bad={"op0", "op1"}, error=failure)
+    accepted, simulated, rejected = batching.validate_operations(
+        simulate, [], candidates
+    )
+    assert accepted == []
+    assert simulated is None
+    assert rejected == [(0, failure), (1, failure)]
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [
+        RpcError("Internal Server Error"),
+        error("proto.018-Proxford.contract.counter_in_the_past"),
+    ],
+)
+def test_validate_operations_fails_on_other_errors(failure):
+    candidates = [(i, f"op{i}") for i in range(4)]
+    simulate = simulator(bad={"op1"}, error=failure)
+    with pytest.raises(RpcError):
+        batching.validate_operations(simulate, [], candidates)
+
+
+def test_error_ids():
+    assert batching.is_counter_error(
+        error("proto.018-Proxford.contract.counter_in_the_future")
+    )
+    assert batching.is_conflict_error(error("prevalidation.operation_conflict"))
+    assert not batching.is_counter_error(RpcError("counter_in_the_past"))
+    assert not batching.is_operation_error(RpcError("Bad Gateway"))
+
+
+# CounterManager
+
+
+def test_counter_manager_resyncs_once():
+    relayer = client(counter=41)
+    counters = batching.CounterManager(relayer)
+    assert counters.next_counter() == 42
+    counters.injected(3)
+    assert counters.counter == 44
+    assert counters.next_counter() == 45
+    assert relayer.shell.contracts.__getitem__.return_value.call_count == 1
+
+
+def test_counter_manager_resync():
+    counters = batching.CounterManager(client(counter=41))
+    counters.counter = 100
+    counters.resync()
+    assert counters.next_counter() == 42
+
+
+def test_counter_manager_set_head():
+    relayer = client(ttl=60)
+    counters = batching.CounterManager(relayer)
+    counters.set_head(1000)
+    counters.set_head(1000)
+    relayer.shell.blocks.__getitem__.assert_called_once_with(
+        1000 - (MAX_OPERATIONS_TTL - 60)
+    )
+    assert counters.branch == "BLbranch"
+    assert counters.expiry_level == 1060
+
+
+# SimulationCache
+
+
+def call(value, entrypoint="default"):
+    return {
+        "destination": "KT1contract",
+        "parameters": {"entrypoint": entrypoint, "value": value},
+    }
+
+
+def test_simulation_cache_key():
+    key = batching.SimulationCache.key
+    assert key([call({"a": 1, "b": 2})]) == key([call({"b": 2, "a": 1})])
+    assert key([call({"a": 1})]) != key([call({"a": 2})])
+    assert key([call({"a": 1})]) != key([call({"a": 1}, entrypoint="mint")])
+
+
+def test_simulation_cache_scope():
+    cache = batching.SimulationCache(10)
+    cache.set(1, "key", "value")
+    assert cache.get(1, "key") == "value"
+    assert cache.get(2, "key") is None
+    cache.set(2, "key", "value")
+    assert cache.get(1, "key") is None
+
+
+def test_simulation_cache_evicts_least_recently_used():
+    cache = batching.SimulationCache(2)
+    cache.set(1, "a", 1)
+    cache.set(1, "b", 2)
+    cache.get(1, "a")
+    cache.set(1, "c", 3)
+    assert cache.get(1, "a") == 1
+    assert cache.get(1, "b") is None
+    assert cache.get(1, "c") == 3
+
+
+def test_simulation_cache_disabled():
+    cache = batching.SimulationCache(0)
+    cache.set(1, "key", "value")
+    assert cache.get(1, "key") is None
+    cache = batching.SimulationCache(10)
+    cache.set(None, "key", "value")
+    assert cache.get(None, "key") is None